@@ -9,83 +9,157 @@ import numpy as np
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 import sys, os
+import threading
+from collections import namedtuple
 
 # Import user libraries
 import tools
 import chart_functions
+import forecasting
+import response_cache
+import figure_cache
+import metrics
+import quantile_sketch
 from sales_metrics_charts import yoy_sales_chart, sales_distribution_histogram, sunburst_chart, sales_metrics_tables
 from sales_lifecycle_charts import ttm_sales_cycle_days, ttm_sales_cycle_strip, ttm_win_rate, customer_acq_cost
 from financial_analysis_charts import income_statement, sankey_chart, revenue_funnel
-from competitor_analysis_charts import competitor_box_plots, pricing_deltas_list, benchmarking_chart
+from competitor_analysis_charts import competitor_box_plots, pricing_delta_tables, pricing_deltas_list, benchmarking_chart
 
 
 # Load Data
-purchases, opportunities, competitors, financials = tools.load_data()
+# Everything loaded for one version of the data, swapped in as a whole so a callback never
+# mixes tables from before and after a reload
+DataState = namedtuple('DataState', ['version', 'purchases', 'opportunities', 'competitors', 'financials',
+                                     'monthly_cube', 'competitor_sketches', 'pricing_tables', 'filter_index', 'data_end'])
+
+def load_state(version):
+    """ Load the data and everything derived from it.
+    Arguments:
+    version (str) -- version of the data being loaded (tools.data_version)
+
+    Returns:
+    state (DataState)
+    """
+    purchases, opportunities, competitors, financials = tools.load_shared() if tools.SHARED_DATA else tools.load_data()
+    monthly_cube = tools.load_monthly_cube(purchases, opportunities, version)
+    competitor_sketches = quantile_sketch.load_sketches(competitors, version)
+    pricing_tables = pricing_delta_tables(monthly_cube, competitor_sketches)
+    filter_index = tools.build_filter_index(purchases, opportunities, competitors, monthly_cube)
+    data_end = purchases['date_purchased'].max() # Forecasts are fit up to the last complete month
+    return DataState(version, purchases, opportunities, competitors, financials,
+                     monthly_cube, competitor_sketches, pricing_tables, filter_index, data_end)
+
+state = load_state(tools.data_version())
+data_lock = threading.Lock()
+
+def refresh_data():
+    """ Reload the data if a batch has been ingested (see ingest.py) since it was loaded.
+    Checking is just a stat of the source files, so this runs at the start of every callback.
+    Callbacks keep the state returned for the whole call rather than reading the global again.
+
+    Returns:
+    state (DataState) -- the current data
+    """
+    global state
+    current = state
+    if tools.data_version() == current.version:
+        return current
+    with data_lock:
+        version = tools.data_version()
+        if version != state.version:
+            state = load_state(version)
+        return state
+
+def current_version():
+    """ Version of the loaded data, after refreshing it if needed. Used to key cached responses.
+    Returns:
+    data version (str)
+    """
+    return refresh_data().version
 
 # Spin up app
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = Dash(__name__, external_stylesheets=external_stylesheets, suppress_callback_exceptions=True)
 server = app.server
 
+server.before_request(metrics.request_started)
+server.after_request(metrics.request_finished)
+
+@server.route('/metrics')
+def prometheus_metrics():
+    """ Callback timings in Prometheus text format """
+    return metrics.render(), 200, {'Content-Type' : 'text/plain; version=0.0.4'}
+
+@server.route('/figure-cache-stats')
+def figure_cache_stats():
+    """ Hit rate and build time saved by the figure cache, per chart """
+    return figure_cache.stats()
+
 
 # Define app layout
-app.layout = html.Div([
-    html.Div([
-        # Title Banner
-        html.H1("RevOps Dashboard for Used Car Sales", className="app_header__title", style={"textAlign":"center"}),
-        html.P("This app acts as a revenue ops dashboard for a fictional used car dealership, leveraging fictional data.", 
-               className="app__header_title--grey", style={"textAlign":"center"})
-    ], className="app_header_desc"),
-    html.Div([
-        html.A(html.Button("SOURCE CODE", className="link-button", style={"textAlign":"right"}), href="https://github.com/arbergmann/revOps_dashboard"),
-        # html.A(html.Img(src=app.get_asset_url("assets/clipart2385495.png"), className="app__menu__img", style={"textAlign":"right"})),
-    ], className="app__header__logo"),
-    ## Car make filter
-    html.Hr(),
-    html.Div([
+def serve_layout():
+    """ Page layout. Built on every page load, so makes added since the app started (see ingest.py)
+    show up in the make dropdown without a restart.
+    """
+    loaded = refresh_data()
+    return html.Div([
         html.Div([
-        dcc.Dropdown(id='make_dd', 
-                    clearable=True, 
-                    value=None,
-                    placeholder='Filter by Car Make (Optional)',
-                    options=[{'label' : i, "value" : i} for i in sorted(purchases['car_make'].unique())]),
-        ], className="two columns"), 
+            # Title Banner
+            html.H1("RevOps Dashboard for Used Car Sales", className="app_header__title", style={"textAlign":"center"}),
+            html.P("This app acts as a revenue ops dashboard for a fictional used car dealership, leveraging fictional data.", 
+                   className="app__header_title--grey", style={"textAlign":"center"})
+        ], className="app_header_desc"),
         html.Div([
-        dcc.Dropdown(id='model_dd', 
-                    clearable=True, 
-                    value=None,
-                    placeholder='Filter by Car Model (Optional)'),
-        ], className="two columns")], 
-        style=dict(display='flex'), className="row"),
-    html.Br(),
-    
-    # Tabs
-    html.Div([
-        dcc.Tabs(id='tabs-div', value='tab-1', children=[
-            dcc.Tab(label='Sales Metrics', value='tab-1'),
-            dcc.Tab(label='Sales Lifecycle', value='tab-2'),
-            dcc.Tab(label='Financial Analysis', value='tab-3'),
-            dcc.Tab(label='Competitor Analysis', value='tab-4')
-        ]),
-    html.Div(id='tabs-content')
+            html.A(html.Button("SOURCE CODE", className="link-button", style={"textAlign":"right"}), href="https://github.com/arbergmann/revOps_dashboard"),
+            # html.A(html.Img(src=app.get_asset_url("assets/clipart2385495.png"), className="app__menu__img", style={"textAlign":"right"})),
+        ], className="app__header__logo"),
+        ## Car make filter
+        html.Hr(),
+        html.Div([
+            html.Div([
+            dcc.Dropdown(id='make_dd', 
+                        clearable=True, 
+                        value=None,
+                        placeholder='Filter by Car Make (Optional)',
+                        options=[{'label' : i, "value" : i} for i in sorted(loaded.purchases['car_make'].unique())]),
+            ], className="two columns"), 
+            html.Div([
+            dcc.Dropdown(id='model_dd', 
+                        clearable=True, 
+                        value=None,
+                        placeholder='Filter by Car Model (Optional)'),
+            ], className="two columns")], 
+            style=dict(display='flex'), className="row"),
+        html.Br(),
+        
+        # Tabs
+        html.Div([
+            dcc.Tabs(id='tabs-div', value='tab-1', children=[
+                dcc.Tab(label='Sales Metrics', value='tab-1'),
+                dcc.Tab(label='Sales Lifecycle', value='tab-2'),
+                dcc.Tab(label='Financial Analysis', value='tab-3'),
+                dcc.Tab(label='Competitor Analysis', value='tab-4')
+            ]),
+        html.Div(id='tabs-content')
+        ])
     ])
-])
+
+app.layout = serve_layout
 
 
 ## Callback for dropdown
 @app.callback(Output(component_id='model_dd', component_property='options'),
               Input(component_id='make_dd', component_property='value'))
+@metrics.instrument
 def update_model_dd(make_value):
-    if make_value is None:
-        return [{'label' : i, "value" : i} for i in sorted(purchases['car_model'].unique())]
-    else:
-        data = purchases[purchases['car_make'] == make_value]
-        return [{'label' : i, "value" : i} for i in sorted(data['car_model'].unique())]
+    filter_index = refresh_data().filter_index
+    return [{'label' : i, "value" : i} for i in tools.models_for_make(filter_index['purchases'], make_value)]
 
 
 # Callback for tabs
 @app.callback(Output('tabs-content', 'children'), 
               Input('tabs-div', 'value'))
+@metrics.instrument
 def render_content(tab):
     if tab == 'tab-1':
         return html.Div([
@@ -113,13 +187,19 @@ def render_content(tab):
 # Callback for basic overall statistics
 @app.callback(Output('overall-stats','children'),
               Input('make_dd', 'value'))
+@metrics.instrument
+@response_cache.cached_response(current_version)
 def overall_stats(make_dd):
+    loaded = refresh_data()
+    purchases, opportunities, data_version = loaded.purchases, loaded.opportunities, loaded.version
+    with metrics.stage('aggregate'):
+        kpis = chart_functions.headline_kpis(purchases, opportunities, data_version)
     return [html.Div([
                 html.Div([
                     dcc.Markdown("""
                                  ### Total Purchases (6m)
                                  ###### {}
-                                 """.format(str(chart_functions.purchase_count(purchases))),
+                                 """.format(str(kpis['purchase_count'])),
                                  style={"textAlign" : "center", "borderWidth": "3px",
                                         "borderStyle": "solid","borderColor": "#4287F5", 
                                         "backgroundColor": "#EEEEEE", "padding": "0.5%",})],
@@ -128,7 +208,7 @@ def overall_stats(make_dd):
                     dcc.Markdown("""
                                  ### Total Opportunities (6m)
                                  ###### {}
-                                 """.format(str(chart_functions.opportunity_count(purchases, opportunities))), 
+                                 """.format(str(kpis['opportunity_count'])),
                                  style={"textAlign" : "center", "borderWidth": "3px",
                                         "borderStyle": "solid","borderColor": "#4287F5", 
                                         "backgroundColor": "#EEEEEE", "padding": "0.5%",})],
@@ -137,7 +217,7 @@ def overall_stats(make_dd):
                     dcc.Markdown("""
                                  ### Total Win Rate
                                  ###### {:.2%}
-                                 """.format(chart_functions.win_rate(purchases, opportunities)),
+                                 """.format(kpis['win_rate']),
                                  style={"textAlign" : "center", "borderWidth": "3px",
                                         "borderStyle": "solid","borderColor": "#4287F5", 
                                         "backgroundColor": "#EEEEEE", "padding": "0.5%",})],
@@ -146,7 +226,7 @@ def overall_stats(make_dd):
                     dcc.Markdown("""
                                  ### Sales Cycle Length
                                  ###### {} Days
-                                 """.format(chart_functions.avg_sales_cycle(purchases)),
+                                 """.format(kpis['avg_sales_cycle']),
                                  style={"textAlign" : "center", "borderWidth": "3px",
                                         "borderStyle": "solid","borderColor": "#4287F5", 
                                         "backgroundColor": "#EEEEEE", "padding": "0.5%",})],
@@ -162,6 +242,8 @@ def overall_stats(make_dd):
 @app.callback(Output('sales-div','children'),
               Input('make_dd', 'value'),
               Input('model_dd', 'value'))
+@metrics.instrument
+@response_cache.cached_response(current_version)
 def sales_metrics_charts(make_value, model_value):
     """ Generate Sales Metrics charts, all filtered by Make/Model
     In order:
@@ -178,33 +260,37 @@ def sales_metrics_charts(make_value, model_value):
     charts (html.Div)
     """
 
+    loaded = refresh_data()
+    purchases, monthly_cube, filter_index, data_version = loaded.purchases, loaded.monthly_cube, loaded.filter_index, loaded.version
+    data_end = loaded.data_end
+
     ## Data filtering based on filtering inputs
-    if ((make_value is None) and (model_value is None)) | ((make_value is None) and (model_value is not None)):
-        data = purchases.copy()
-        pth = ['car_make', 'car_model']
-    elif (make_value is None) and (model_value is not None):
-        data = purchases.copy()
+    with metrics.stage('filter'):
+        data = tools.filter_rows(purchases, filter_index['purchases'], make_value, model_value)
+        cube = tools.filter_rows(monthly_cube, filter_index['monthly_cube'], make_value, model_value)
+    if make_value is None:
         pth = ['car_make', 'car_model']
-    elif (make_value is not None) and (model_value is None):
-        data = purchases[purchases['car_make'] == make_value]
-        pth = ['car_model', 'car_year']
     else:
-        data = purchases[(purchases['car_make'] == make_value) & (purchases['car_model'] == model_value)]
         pth = ['car_model', 'car_year']
 
 
     ## Histogram
-    fig_hist = sales_distribution_histogram(make_value, model_value, data)
+    fig_hist = figure_cache.cached_figure('sales_histogram', (make_value, model_value), data_version,
+                                          sales_distribution_histogram, make_value, model_value, data)
 
 
-    ## YoY Sales
-    fig_yoy = yoy_sales_chart(data)
+    ## YoY Sales, the forecasts of every series are made together in one batch
+    with metrics.stage('model'):
+        forecasting.batch_forecasts(monthly_cube, filter_index, data_version, ci=0.10, data_end=data_end)
+    fig_yoy = figure_cache.cached_figure('yoy_sales', (make_value, model_value), data_version,
+                                         yoy_sales_chart, cube, make_value, model_value, data_version, data_end)
 
     ## Sunburst breakdown
-    fig_sburst = sunburst_chart(data, pth)
+    fig_sburst = figure_cache.cached_figure('sunburst', (make_value, model_value), data_version, sunburst_chart, data, pth)
 
     ## Tables
-    top_5_sales, top_5_count = sales_metrics_tables(make_value, data)
+    with metrics.stage('aggregate'):
+        top_5_sales, top_5_count = sales_metrics_tables(make_value, data)
 
     ## Return all charts back to tab
     return [html.Div([dcc.Graph(figure=fig_yoy)],className="row"),
@@ -229,6 +315,8 @@ def sales_metrics_charts(make_value, model_value):
 @app.callback(Output('sales-lifecycle-div','children'),
               Input('make_dd', 'value'),
               Input('model_dd', 'value'))
+@metrics.instrument
+@response_cache.cached_response(current_version)
 def sales_lifecycle_charts(make_value, model_value):
     """ Generate Sales Lifecycle charts, all filtered by Make/Model
     In order:
@@ -249,32 +337,28 @@ def sales_lifecycle_charts(make_value, model_value):
     charts (html.Div)
     """
 
+    loaded = refresh_data()
+    purchases, monthly_cube, filter_index, financials, data_version = loaded.purchases, loaded.monthly_cube, loaded.filter_index, loaded.financials, loaded.version
+
     ## Data filtering based on filtering inputs
-    if ((make_value is None) and (model_value is None)) | ((make_value is None) and (model_value is not None)):
-        data_p = purchases.copy()
-        data_o = opportunities.copy()
-    elif (make_value is None) and (model_value is not None):
-        data_p = purchases.copy()
-        data_o = opportunities.copy()
-    elif (make_value is not None) and (model_value is None):
-        data_p = purchases[purchases['car_make'] == make_value]
-        data_o = opportunities[opportunities['car_make_interest'] == make_value]
-    else:
-        data_p = purchases[(purchases['car_make'] == make_value) & (purchases['car_model'] == model_value)]
-        data_o = opportunities[(opportunities['car_make_interest'] == make_value) & (opportunities['car_model_interest'] == model_value)]
+    with metrics.stage('filter'):
+        data_p = tools.filter_rows(purchases, filter_index['purchases'], make_value, model_value)
+        cube = tools.filter_rows(monthly_cube, filter_index['monthly_cube'], make_value, model_value)
 
 
     ## Trailing Twelve Months Sales Lifecycle Chart
-    fig_ttm_cycle = ttm_sales_cycle_days(data_p)
+    fig_ttm_cycle = figure_cache.cached_figure('ttm_sales_cycle', (make_value, model_value), data_version, ttm_sales_cycle_days, cube)
 
     ## Trailing Twelve Months Sales Lifecycle by Model - Strip
-    fig_strip_sales = ttm_sales_cycle_strip(make_value, data_p)
+    fig_strip_sales = figure_cache.cached_figure('ttm_sales_cycle_strip', (make_value, model_value), data_version,
+                                                 ttm_sales_cycle_strip, make_value, data_p)
 
     ## Trailing Twelve Months Win Rate
-    fig_ttm_winrt = ttm_win_rate(data_p, data_o)
+    fig_ttm_winrt = figure_cache.cached_figure('ttm_win_rate', (make_value, model_value), data_version, ttm_win_rate, cube)
 
     ## Customer Acquisition Trends
-    fig_cust_cost, trend_yoy, trend_qoq, _, _ = customer_acq_cost(data_p, financials)
+    with metrics.stage('figure', 'customer_acq_cost'):
+        fig_cust_cost, trend_yoy, trend_qoq, _, _ = customer_acq_cost(cube, financials)
 
 
     return [html.Div([
@@ -338,6 +422,8 @@ def sales_lifecycle_charts(make_value, model_value):
 
 @app.callback(Output('financial-analysis-div','children'),
               Input('make_dd', 'value'))
+@metrics.instrument
+@response_cache.cached_response(current_version)
 def financial_analysis_charts(slider_output):
     """ Generate Financial Analysis charts, NO RESPONSE TO FILTERS
     In order:
@@ -351,16 +437,18 @@ def financial_analysis_charts(slider_output):
     Returns:
     charts (html.Div)
     """
-    global financials
+    loaded = refresh_data()
+    financials, data_version = loaded.financials, loaded.version
 
     ## Financial Statements
-    financial_statements = income_statement(financials)
+    with metrics.stage('aggregate'):
+        financial_statements = income_statement(financials)
 
     ## Sankey Chart
-    fig_sankey = sankey_chart(financials, '2023_q1')
+    fig_sankey = figure_cache.cached_figure('sankey', (), data_version, sankey_chart, financials, '2023_q1')
 
     ## Revenue Funnel
-    fig_funnel = revenue_funnel(financials)
+    fig_funnel = figure_cache.cached_figure('revenue_funnel', (), data_version, revenue_funnel, financials)
 
     return [html.Div([
                 html.Div([dcc.Markdown("**Note:** These charts do not change by filtering at this time.")], style={"textAlign":"center", "verticalAlign":"center"}),
@@ -385,6 +473,8 @@ def financial_analysis_charts(slider_output):
 @app.callback(Output('competitor-analysis-div','children'),
               Input('make_dd', 'value'),
               Input('model_dd', 'value'))
+@metrics.instrument
+@response_cache.cached_response(current_version)
 def competitor_analysis_charts(make_value, model_value):
     """ Generate competitor analysis charts
     In order:
@@ -399,34 +489,26 @@ def competitor_analysis_charts(make_value, model_value):
     Returns:
     charts (html.Div)
     """
-    global purchases, competitors
+    loaded = refresh_data()
+    purchases, competitors, filter_index, data_version = loaded.purchases, loaded.competitors, loaded.filter_index, loaded.version
+    pricing_tables, competitor_sketches = loaded.pricing_tables, loaded.competitor_sketches
 
     ## Data filtering based on inputs
-    if ((make_value is None) and (model_value is None)) | ((make_value is None) and (model_value is not None)):
-        data_p = purchases.copy()
-        data_c = competitors.copy()
-        # Only provide intersection of data
-        intersection = list(set(data_p['car_make']) & set(data_c['car_make']))
-        data_p = data_p[(data_p['car_make'].isin(intersection))]
-        data_c = data_c[(data_c['car_make'].isin(intersection))]
-    # If make selected, but not model
-    elif (make_value is not None) and (model_value is None):
-        data_p = purchases.copy()
-        data_c = competitors.copy()
-        data_p = data_p[data_p['car_make'] == make_value]
-        # Only provide intersection of data, what can be seen in purchase data
-        intersection = list(set(data_p['car_model']) & set(data_c['car_model']))
-        data_p = data_p[(data_p['car_make'] == make_value) & (data_p['car_model'].isin(intersection))]
-        data_c = data_c[(data_c['car_make'] == make_value) & (data_c['car_model'].isin(intersection))]
-    # If make & model selected
-    else:
-        data_p = purchases.copy()
-        data_c = competitors.copy()
-        data_p = data_p[(data_p['car_make'] == make_value) & (data_p['car_model'] == model_value)]
-        # Only provide intersection of data, what can be seen in purchase data
-        intersection = list(set(data_p['car_model']) & set(data_c['car_model']))
-        data_p = data_p[(data_p['car_make'] == make_value) & (data_p['car_model'].isin(intersection))]
-        data_c = data_c[(data_c['car_make'] == make_value) & (data_c['car_model'].isin(intersection))]
+    with metrics.stage('filter'):
+        if make_value is None:
+            # Only provide intersection of data
+            intersection = list(set(filter_index['purchases']['make']) & set(filter_index['competitors']['make']))
+            data_p = tools.filter_makes(purchases, filter_index['purchases'], intersection)
+            data_c = tools.filter_makes(competitors, filter_index['competitors'], intersection)
+        # If make selected (and maybe model)
+        else:
+            data_p = tools.filter_rows(purchases, filter_index['purchases'], make_value, model_value)
+            data_c = tools.filter_rows(competitors, filter_index['competitors'], make_value)
+            # Only provide intersection of data, what can be seen in purchase data
+            competitor_models = {model for (_, model) in filter_index['competitors']['make_model']}
+            intersection = list(set(data_p['car_model']) & competitor_models)
+            data_p = data_p[data_p['car_model'].isin(intersection)]
+            data_c = data_c[data_c['car_model'].isin(intersection)]
 
 
     if (model_value is not None) and ((len(intersection) == 0) or (model_value not in intersection)):
@@ -442,22 +524,15 @@ def competitor_analysis_charts(make_value, model_value):
 
     else:
         ## Competitor Price Box Plots
-        fig_boxes = competitor_box_plots(make_value, model_value, data_c, data_p)
+        fig_boxes = figure_cache.cached_figure('competitor_boxes', (make_value, model_value), data_version,
+                                               competitor_box_plots, make_value, model_value, data_c, data_p)
     
-        ## Top opportunities for pricing increases
-        if make_value is None:
-            competitor_meds = pd.DataFrame(competitors.groupby('car_make')['purchase_price'].median()).rename(columns={'purchase_price':'Competitor Median'})
-            purchase_avgs = pd.DataFrame(purchases.groupby(['car_make']).agg({'purchase_price' : [np.mean, 'count']}).droplevel(axis=1, level=0)).rename(columns={'mean': 'Average Price', 'count':'Count'})
-
-        else:
-            competitor_meds = pd.DataFrame(competitors.groupby('car_model')['purchase_price'].median()).rename(columns={'purchase_price':'Competitor Median'})
-            purchase_avgs = pd.DataFrame(purchases.groupby(['car_model']).agg({'purchase_price' : [np.mean, 'count']}).droplevel(axis=1, level=0)).rename(columns={'mean': 'Average Price', 'count':'Count'})
-
-        # Pricing Deltas
-        pricing_deltas = pricing_deltas_list(competitor_meds, purchase_avgs)
+        ## Top opportunities for pricing increases, from the pre-sorted pricing delta tables
+        with metrics.stage('aggregate'):
+            pricing_deltas = pricing_deltas_list(pricing_tables['car_make' if make_value is None else 'car_model'])
 
         ## Benchmarking
-        fig_line = benchmarking_chart(competitors, purchases)
+        fig_line = figure_cache.cached_figure('benchmarking', (), data_version, benchmarking_chart, competitors, purchases, competitor_sketches)
 
         ## Return all charts back to tab
         return [html.Div([
@@ -477,6 +552,10 @@ def competitor_analysis_charts(make_value, model_value):
 
 
 
+# Pre-fit forecasts in the background (opt in with FORECAST_WARMUP=1)
+forecasting.start_warm_up(state.monthly_cube, state.filter_index, state.version, data_end=state.data_end)
+
+
 if __name__ == '__main__':
     app.run(debug=False)
 # %%
@@ -0,0 +1,423 @@
+#%%
+import os, sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import warnings
+from datetime import date
+import pandas as pd
+import numpy as np
+import plotly
+import plotly.graph_objects as go
+
+import tools
+import chart_functions
+import forecasting
+import figure_cache
+import data_cleaning
+import quantile_sketch
+from sales_metrics_charts import yoy_sales_chart, sales_distribution_histogram, sunburst_chart, sales_metrics_tables
+from sales_lifecycle_charts import ttm_sales_cycle_days, ttm_sales_cycle_strip, ttm_win_rate, customer_acq_cost
+from financial_analysis_charts import income_statement, sankey_chart, revenue_funnel
+from competitor_analysis_charts import competitor_box_plots, pricing_delta_table, pricing_delta_tables, pricing_deltas_list, benchmarking_chart
+
+"""
+Benchmarks for loading the data, every chart builder and every app callback, on
+synthetic data of increasing size.
+
+For each size, synthetic csv files are written to a temporary assets directory and every
+case is timed (best of --repeat runs, with the app's caches cleared before each run), then
+run once more under tracemalloc for its peak memory. The size of what it would send to the
+browser (figure/table/response JSON) is recorded as the payload.
+
+Run from the src directory:
+    python benchmark.py --sizes 10k 100k --out before.json
+    python benchmark.py --sizes 10k 100k --out after.json
+    python benchmark.py --compare before.json after.json
+"""
+
+SIZES = {'10k' : 10000, '100k' : 100000, '1m' : 1000000, '10m' : 10000000}
+
+# Numbers of makes the per-category charts are benchmarked with, and rows of each
+CATEGORY_COUNTS = [10, 100, 1000]
+ROWS_PER_CATEGORY = 20
+
+N_MAKES = 60
+MODELS_PER_MAKE = 12
+COLORS = ['Black', 'Blue', 'Crimson', 'Green', 'Orange', 'Purple', 'Red', 'Silver', 'Teal', 'White']
+GENDERS = ['Female', 'Male', 'Non-binary', 'Polygender']
+NAMES = ['Alex', 'Berty', 'Casey', 'Dacia', 'Duffie', 'Eli', 'Gwynne', 'Kyla', 'Morgan', 'Oki', 'Robin', 'Sam']
+
+
+def synthetic_catalog():
+    """ Synthetic makes and models, with a long tail of popularity like the real data.
+    Returns:
+    pairs (DataFrame) -- car_make, car_model and the probability of each pair
+    """
+    makes = np.repeat([f'Make {i:02d}' for i in range(N_MAKES)], MODELS_PER_MAKE)
+    models = [f'{make} M{j:02d}' for make, j in zip(makes, np.tile(np.arange(MODELS_PER_MAKE), N_MAKES))]
+    weight = 1 / np.arange(1, len(makes) + 1)
+    return pd.DataFrame({'car_make' : makes, 'car_model' : models, 'p' : weight / weight.sum()})
+
+
+def synthetic_data(n_purchases, seed=0):
+    """ Synthetic raw datasets shaped like the csv files data_cleaning.py writes, covering the
+    five years up to today. There are as many opportunities and competitor sales as purchases.
+    Arguments:
+    n_purchases (int) -- number of purchases
+    seed (int) -- random seed
+
+    Returns:
+    data (dict) -- dataset name (tools.DATASETS) -> DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    catalog = synthetic_catalog()
+    today = np.datetime64(date.today(), 'D')
+    n = n_purchases
+
+    def pick(k):
+        rows = catalog.iloc[rng.choice(len(catalog), size=k, p=catalog['p'])]
+        return rows['car_make'].values, rows['car_model'].values
+
+    # Purchases
+    make, model = pick(n)
+    date_purchased = today - rng.integers(0, 5 * 365, size=n)
+    financed = rng.random(n) < 0.6
+    purchases = pd.DataFrame({'opportunity_created' : date_purchased - rng.integers(1, 180, size=n),
+                              'date_purchased' : date_purchased,
+                              'first_name' : rng.choice(NAMES, n), 'last_name' : rng.choice(NAMES, n),
+                              'email' : rng.choice(NAMES, n), 'gender' : rng.choice(GENDERS, n),
+                              'financed' : financed, 'pct_financed' : np.where(financed, rng.uniform(0, 0.95, n).round(2), 0),
+                              'car_make' : make, 'car_model' : model, 'car_year' : rng.integers(2010, 2024, n),
+                              'car_color' : rng.choice(COLORS, n), 'purchase_price' : rng.integers(10000, 100000, n),
+                              'car_tier' : rng.choice(data_cleaning.TIERS, n)})
+
+    # Opportunities, some without a make/model of interest
+    make, model = pick(n)
+    no_make = rng.random(n) < 0.1
+    no_model = no_make | (rng.random(n) < 0.1)
+    opportunities = pd.DataFrame({'opportunity_created' : today - rng.integers(0, 5 * 365, size=n),
+                                  'first_name' : rng.choice(NAMES, n), 'last_name' : rng.choice(NAMES, n),
+                                  'email' : rng.choice(NAMES, n), 'gender' : rng.choice(GENDERS, n),
+                                  'financing_reqd' : rng.random(n) < 0.6, 'pct_financed' : rng.uniform(0, 0.95, n),
+                                  'car_make_interest' : np.where(no_make, None, make),
+                                  'car_model_interest' : np.where(no_model, None, model),
+                                  'car_year_interest' : rng.integers(1995, 2024, n).astype(float),
+                                  'car_color_interest' : rng.choice(COLORS, n),
+                                  'purchase_price_range' : rng.integers(10000, 100000, n),
+                                  'car_year' : rng.integers(2010, 2024, n).astype(float)})
+
+    # Competitor sales, over the last year
+    make, model = pick(n)
+    competitors = pd.DataFrame({'date_purchased' : today - rng.integers(0, 365, size=n),
+                                'company' : rng.choice(NAMES, n), 'car_make' : make, 'car_model' : model,
+                                'car_year' : rng.integers(2010, 2024, n), 'car_color' : rng.choice(COLORS, n),
+                                'purchase_price' : rng.integers(10000, 100000, n),
+                                'car_tier' : rng.choice(data_cleaning.TIERS, n)})
+
+    financials = data_cleaning.generate_financials(data_cleaning.car_sales_start(purchases), seed=seed)
+
+    return {'purchases' : purchases, 'opportunities' : opportunities,
+            'competitors' : competitors, 'financials' : financials}
+
+
+def write_synthetic(root, n_purchases, seed=0):
+    """ Write synthetic datasets to root/assets, laid out like the repository so that the
+    app can be run from root/src.
+    Arguments:
+    root (str) -- directory to write to
+    n_purchases (int) -- number of purchases
+    seed (int) -- random seed
+
+    Returns:
+    src (str) -- path of the src directory to run from
+    """
+    os.makedirs(root + '/assets', exist_ok=True)
+    os.makedirs(root + '/src', exist_ok=True)
+    for name, df in synthetic_data(n_purchases, seed).items():
+        df.to_csv(root + '/assets/' + tools.DATASETS[name])
+    return root + '/src'
+
+
+def payload_size(result):
+    """ Size of what a result would send to the browser.
+    Arguments:
+    result -- chart figure, table, callback response or value
+
+    Returns:
+    size (int) -- bytes of JSON
+    """
+    if isinstance(result, tuple):
+        return sum(payload_size(r) for r in result)
+    if isinstance(result, pd.DataFrame):
+        return len(result.to_json(orient='records'))
+    try:
+        return len(json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder))
+    except TypeError:
+        # Passing default= to the plotly encoder would replace its own default, turning figures into their repr
+        return len(json.dumps(result, default=str))
+
+
+def clear_caches():
+    """ Empty the app's in-memory result caches, so every run builds its result from scratch """
+    chart_functions.kpi_cache.clear()
+    forecasting.forecast_store.clear()
+    forecasting.batch_store.clear()
+    figure_cache.figure_store.clear()
+
+
+def measure(func, repeat=3, payload=True):
+    """ Time a benchmark case and measure its peak memory and payload.
+    Arguments:
+    func (function) -- case to run, without arguments
+    repeat (int) -- number of timed runs, the fastest is kept
+    payload (bool) -- measure the payload, False for cases whose result never goes to the browser
+
+    Returns:
+    metrics (dict) -- seconds, peak_mb, payload_bytes (None without payload), traces (for figures) or error
+    """
+    try:
+        times = []
+        for _ in range(repeat):
+            clear_caches()
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+
+        clear_caches()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {'error' : repr(e)}
+
+    return {'seconds' : min(times), 'peak_mb' : peak / 2**20, 'payload_bytes' : payload_size(result) if payload else None,
+            'traces' : len(result.data) if isinstance(result, go.Figure) else None}
+
+
+def chart_cases(purchases, opportunities, competitors, financials, monthly_cube, make, model):
+    """ Every chart builder and helper, called with the unfiltered data the way the app calls them.
+    Arguments:
+    purchases, opportunities, competitors, financials (DataFrame) -- loaded datasets
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    make (str) -- make to filter on for the per-make charts
+    model (str) -- model of that make
+
+    Returns:
+    cases (dict) -- case name -> function without arguments
+    """
+    cube_make = monthly_cube[monthly_cube['car_make'] == make]
+    purchases_make = purchases[purchases['car_make'] == make]
+    competitors_make = competitors[competitors['car_make'] == make]
+    competitor_meds = pd.DataFrame(competitors.groupby('car_make', observed=True)['purchase_price'].median().sort_index()).rename(columns={'purchase_price':'Competitor Median'})
+    purchase_avgs = pd.DataFrame(purchases.groupby(['car_make'], observed=True).agg({'purchase_price' : [np.mean, 'count']}).sort_index().droplevel(axis=1, level=0)).rename(columns={'mean': 'Average Price', 'count':'Count'})
+    sketches = quantile_sketch.build_sketches(competitors)
+    pricing_tables = pricing_delta_tables(monthly_cube, sketches)
+    filter_index = tools.build_filter_index(purchases, opportunities, competitors, monthly_cube)
+    data_end = purchases['date_purchased'].max()
+
+    return {
+        'chart_functions.purchase_count' : lambda: chart_functions.purchase_count(purchases),
+        'chart_functions.opportunity_count' : lambda: chart_functions.opportunity_count(purchases, opportunities),
+        'chart_functions.win_rate' : lambda: chart_functions.win_rate(purchases, opportunities),
+        'chart_functions.avg_sales_cycle' : lambda: chart_functions.avg_sales_cycle(purchases),
+        'chart_functions.headline_kpis' : lambda: chart_functions.headline_kpis(purchases, opportunities),
+        'chart_functions.monthly_totals' : lambda: chart_functions.monthly_totals(monthly_cube, 'purchase_count'),
+        'chart_functions.monthly_calendar' : lambda: chart_functions.monthly_calendar(cube_make, 'purchase_count'),
+        'chart_functions.index_list' : lambda: chart_functions.index_list(monthly_cube),
+        'chart_functions.arima_predictions' : lambda: chart_functions.arima_predictions(monthly_cube, ci=0.10, data_end=data_end),
+        'forecasting.batch_forecasts' : lambda: forecasting.batch_forecasts(monthly_cube, filter_index, None, data_end=data_end)['arima'],
+        'chart_functions.box_stats' : lambda: chart_functions.box_stats(competitors, 'car_make', 'purchase_price'),
+        'chart_functions.stratified_sample' : lambda: chart_functions.stratified_sample(purchases, 'car_make', chart_functions.STRIP_SAMPLE_SIZE),
+        'sales_metrics_charts.yoy_sales_chart' : lambda: yoy_sales_chart(monthly_cube, data_end=data_end),
+        'sales_metrics_charts.yoy_sales_chart[make]' : lambda: yoy_sales_chart(cube_make, make, data_end=data_end),
+        'sales_metrics_charts.sales_distribution_histogram' : lambda: sales_distribution_histogram(None, None, purchases),
+        'sales_metrics_charts.sunburst_chart' : lambda: sunburst_chart(purchases, ['car_make', 'car_model']),
+        'sales_metrics_charts.sales_metrics_tables' : lambda: sales_metrics_tables(None, purchases),
+        'sales_lifecycle_charts.ttm_sales_cycle_days' : lambda: ttm_sales_cycle_days(monthly_cube),
+        'sales_lifecycle_charts.ttm_sales_cycle_strip' : lambda: ttm_sales_cycle_strip(None, purchases),
+        'sales_lifecycle_charts.ttm_win_rate' : lambda: ttm_win_rate(monthly_cube),
+        'sales_lifecycle_charts.customer_acq_cost' : lambda: customer_acq_cost(monthly_cube, financials)[0],
+        'competitor_analysis_charts.competitor_box_plots' : lambda: competitor_box_plots(None, None, competitors, purchases),
+        'competitor_analysis_charts.competitor_box_plots[make]' : lambda: competitor_box_plots(make, None, competitors_make, purchases_make),
+        'competitor_analysis_charts.pricing_delta_table' : lambda: pricing_delta_table(competitor_meds, purchase_avgs),
+        'competitor_analysis_charts.pricing_delta_tables' : lambda: pricing_delta_tables(monthly_cube, sketches),
+        'competitor_analysis_charts.pricing_deltas_list' : lambda: pricing_deltas_list(pricing_tables['car_model']),
+        'competitor_analysis_charts.benchmarking_chart' : lambda: benchmarking_chart(competitors, purchases),
+        'competitor_analysis_charts.benchmarking_chart[sketches]' : lambda: benchmarking_chart(competitors, purchases, sketches),
+        'quantile_sketch.build_sketches' : lambda: quantile_sketch.build_sketches(competitors),
+        'quantile_sketch.sketch_medians' : lambda: quantile_sketch.sketch_medians(sketches, 'car_model'),
+        'financial_analysis_charts.income_statement' : lambda: income_statement(financials),
+        'financial_analysis_charts.sankey_chart' : lambda: sankey_chart(financials, '2023_q1'),
+        'financial_analysis_charts.revenue_funnel' : lambda: revenue_funnel(financials),
+    }
+
+
+def category_cases(seed=0):
+    """ Charts that draw something per make/model, on synthetic data with CATEGORY_COUNTS makes
+    of ROWS_PER_CATEGORY rows each, so their cost and trace count can be followed as the number
+    of categories grows. Each case builds the figure and serializes it, as the app's response does.
+    Arguments:
+    seed (int) -- random seed of the synthetic data
+
+    Returns:
+    cases (dict) -- case name -> function without arguments
+    """
+    rng = np.random.default_rng(seed)
+    cases = {}
+    for n in CATEGORY_COUNTS:
+        makes = np.repeat([f'Make {i:04d}' for i in range(n)], ROWS_PER_CATEGORY)
+        data_c = pd.DataFrame({'car_make' : makes, 'purchase_price' : rng.integers(10000, 100000, len(makes))})
+        data_p = pd.DataFrame({'car_make' : makes, 'purchase_price' : rng.integers(10000, 100000, len(makes))})
+
+        def build_and_serialize(data_c=data_c, data_p=data_p):
+            fig = competitor_box_plots(None, None, data_c, data_p)
+            fig.to_json()
+            return fig
+        cases[f'competitor_analysis_charts.competitor_box_plots[{n} categories]'] = build_and_serialize
+    return cases
+
+
+def callback_cases(app, make, model):
+    """ Every app callback, called directly, unfiltered, filtered on a make and on a make/model.
+    Arguments:
+    app (module) -- the imported app module
+    make (str) -- make to filter on
+    model (str) -- model of that make
+
+    Returns:
+    cases (dict) -- case name -> function without arguments
+    """
+    cases = {'app.update_model_dd' : lambda: app.update_model_dd(make),
+             'app.render_content' : lambda: app.render_content('tab-1'),
+             'app.overall_stats' : lambda: app.overall_stats(None),
+             'app.financial_analysis_charts' : lambda: app.financial_analysis_charts(None)}
+    for callback in ['sales_metrics_charts', 'sales_lifecycle_charts', 'competitor_analysis_charts']:
+        for label, args in [('', (None, None)), ('[make]', (make, None)), ('[make/model]', (make, model))]:
+            cases[f'app.{callback}{label}'] = (lambda f, a: lambda: f(*a))(getattr(app, callback), args)
+    return cases
+
+
+def run_size(n_purchases, repeat=3, seed=0):
+    """ Benchmark every case on synthetic data of one size.
+    Arguments:
+    n_purchases (int) -- number of purchases
+    repeat (int) -- number of timed runs per case
+    seed (int) -- random seed of the synthetic data
+
+    Returns:
+    results (dict) -- case name -> metrics (see measure)
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(write_synthetic(root, n_purchases, seed))
+        try:
+            # Time loading without the cache, then with it (the first load writes it)
+            results = {'tools.load_data[csv]' : measure(lambda: tools.load_data(use_cache=False, compact=False), repeat, payload=False)}
+            tools.load_data(compact=False)
+            results['tools.load_data[cache]'] = measure(lambda: tools.load_data(compact=False), repeat, payload=False)
+            results['tools.load_data[compact]'] = measure(lambda: tools.load_data(compact=True), repeat, payload=False)
+            tools.load_data(compact=True, report=True)
+
+            purchases, opportunities, competitors, financials = tools.load_data(compact=False)
+            monthly_cube = tools.build_monthly_cube(purchases, opportunities)
+            make = purchases['car_make'].value_counts().index[0]
+            model = purchases[purchases['car_make'] == make]['car_model'].value_counts().index[0]
+
+            for name, func in chart_cases(purchases, opportunities, competitors, financials, monthly_cube, make, model).items():
+                results[name] = measure(func, repeat)
+
+            # The app loads its data on import, and reloads it when the data version changes
+            if 'app' in sys.modules:
+                sys.modules['app'].refresh_data()
+            import app
+            for name, func in callback_cases(app, make, model).items():
+                results[name] = measure(func, repeat)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def run(sizes, repeat=3, seed=0):
+    """ Benchmark every case at each size.
+    Arguments:
+    sizes (list) -- size names, keys of SIZES
+    repeat (int) -- number of timed runs per case
+    seed (int) -- random seed of the synthetic data
+
+    Returns:
+    results (dict) -- run details, and size -> case name -> metrics
+    """
+    results = {'meta' : {'date' : date.today().isoformat(), 'python' : sys.version.split()[0],
+                         'pandas' : pd.__version__, 'plotly' : plotly.__version__,
+                         'repeat' : repeat, 'seed' : seed},
+               'results' : {}}
+    for size in sizes:
+        print(f'Benchmarking {size} purchases...', flush=True)
+        results['results'][size] = run_size(SIZES[size], repeat, seed)
+        print_results(results['results'][size])
+
+    print(f'Benchmarking {", ".join(map(str, CATEGORY_COUNTS))} categories...', flush=True)
+    results['results']['categories'] = {name : measure(func, repeat) for name, func in category_cases(seed).items()}
+    print_results(results['results']['categories'])
+    return results
+
+
+def print_results(results):
+    """ Print one size's metrics as a table """
+    for name, m in results.items():
+        if 'error' in m:
+            print(f'  {name:60s} ERROR {m["error"]}')
+        else:
+            payload = '' if m['payload_bytes'] is None else f'{m["payload_bytes"] / 1024:10.1f} KiB'
+            traces = '' if m.get('traces') is None else f'{m["traces"]:6d} traces'
+            print(f'  {name:60s} {m["seconds"]:9.4f}s {m["peak_mb"]:9.1f} MB {payload} {traces}')
+
+
+def compare(before, after):
+    """ Print the change in time, peak memory and payload between two saved runs.
+    Arguments:
+    before (dict) -- results of the earlier run, as saved by run
+    after (dict) -- results of the later run
+    """
+    for size in after['results']:
+        if size not in before['results']:
+            continue
+        label = f'{size} purchases' if size in SIZES else size
+        print(f'{label}: {"time":>24s} {"peak memory":>24s} {"payload":>24s} {"traces":>24s}')
+        for name, b in before['results'][size].items():
+            a = after['results'][size].get(name)
+            if a is None or 'error' in a or 'error' in b:
+                continue
+            cols = []
+            for key, scale in [('seconds', 1), ('peak_mb', 1), ('payload_bytes', 1 / 1024), ('traces', 1)]:
+                if b.get(key) is None or a.get(key) is None:
+                    continue
+                ratio = a[key] / b[key] if b[key] else float('nan')
+                cols.append(f'{b[key] * scale:9.3f} -> {a[key] * scale:9.3f} ({ratio:5.2f}x)')
+            print(f'  {name:60s} ' + ' '.join(cols))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the data loading, charts and callbacks on synthetic data.")
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES), help="numbers of purchases to benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per case, the fastest is kept")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument('--out', help="save the results as json")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two saved results instead of running")
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore') # statsmodels warns on every forecast fit
+
+    if args.compare:
+        with open(args.compare[0]) as b, open(args.compare[1]) as a:
+            compare(json.load(b), json.load(a))
+    else:
+        results = run(args.sizes, args.repeat, args.seed)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
@@ -7,6 +7,8 @@ from statsmodels.tsa.arima.model import ARIMA, ARIMAResults
 from warnings import catch_warnings, filterwarnings
 import pandas as pd
 import numpy as np
+import os
+import tools
 
 """
 The code for the app.py can be quite cumbersome as it is managing an entire app.
@@ -16,6 +18,14 @@ that act as helper functions for various charts and markdowns, that will help
 to condense the other code a little bit.
 """
 
+# Above this many rows, the distribution charts are sent to the browser aggregated
+# (box plot statistics, a sample of strip plot points) instead of point by point
+AGGREGATE_ROWS = int(os.environ.get('AGGREGATE_ROWS', 20000))
+
+# Points per category kept when a strip plot is sampled
+STRIP_SAMPLE_SIZE = int(os.environ.get('STRIP_SAMPLE_SIZE', 300))
+
+
 def purchase_count(data):
     """ Calculate the count of purchases made.
     Arguments:
@@ -70,60 +80,166 @@ def avg_sales_cycle(purchase_data):
     Returns:
     average sales cycle days (int) -- a count of the average days from opportunity to purchase.
     """
-    data = purchase_data[purchase_data['date_purchased'] > pd.to_datetime(date.today() + relativedelta(months=-6))].copy()
-    data['time_delta'] = data['date_purchased'] - data['opportunity_created']
-    return np.mean(data['time_delta']).days
+    data = purchase_data[purchase_data['date_purchased'] > pd.to_datetime(date.today() + relativedelta(months=-6))]
+    return int(np.floor(data['sales_cycle_days'].mean()))
 
-def index_list(purchase_data):
-    """ Gets index list of month/year combinations
+kpi_cache = tools.LRUCache(maxsize=32)
+
+def kpi_arrays(purchase_data, opportunity_data):
+    """ Date-sorted arrays behind the headline KPIs. Purchase dates come with prefix sums of
+    the sales cycle length, so any trailing window is two searchsorted lookups.
     Arguments:
     purchase_data (DataFrame) -- purchase data previously loaded in from csv
+    opportunity_data (DataFrame) -- opportunity data previously loaded in from csv
 
     Returns:
-    index list (list) -- List of year/month combinations
+    arrays (dict) -- sorted purchase/opportunity dates and sales cycle prefix sums
     """
-    
-    data = purchase_data.groupby(['year','month'])['purchase_price'].sum().reset_index()
-    for col in ['year','month']:
-        data[col] = data[col].apply(lambda x: str(x))
-    data['idx'] = data.year.str.cat(data.month, sep='-')
- 
-    return list(data.idx)
-
-def arima_predictions(purchase_data, ci=0.05):
-    """ Predict sales for 6 months out with confidence interval using past purchase data.
+    purchased = purchase_data['date_purchased'].values
+    cycle = purchase_data['sales_cycle_days'].values.astype(np.float64)
+    keep = ~np.isnat(purchased)
+    order = np.argsort(purchased[keep], kind='stable')
+    purchased = purchased[keep][order]
+    cycle = cycle[keep][order]
+
+    cycle_valid = ~np.isnan(cycle)
+    cycle_days = np.where(cycle_valid, cycle, 0).astype(np.int64)
+
+    created = opportunity_data['opportunity_created'].values
+    created = np.sort(created[~np.isnat(created)])
+
+    return {'purchased' : purchased,
+            'cycle_days' : np.concatenate([[0], np.cumsum(cycle_days)]),
+            'cycle_count' : np.concatenate([[0], np.cumsum(cycle_valid)]),
+            'created' : created}
+
+def headline_kpis(purchase_data, opportunity_data, data_version=None, as_of=None):
+    """ All of the Overall Statistics numbers in one pass, matching purchase_count, opportunity_count,
+    win_rate and avg_sales_cycle. Results are memoized per (data version, as-of date) when a data version is given.
     Arguments:
     purchase_data (DataFrame) -- purchase data previously loaded in from csv
+    opportunity_data (DataFrame) -- opportunity data previously loaded in from csv
+    data_version (str) -- version of the loaded data (tools.data_version)
+    as_of (date) -- date the trailing windows end on, defaults to today
 
     Returns:
-    arima_preds (DataFrame) -- arima predictions with confidence interval.
+    kpis (dict) -- purchase_count, opportunity_count, win_rate (decimal pct) and avg_sales_cycle (days)
     """
-    
-    data = purchase_data.groupby(['year','month'])['purchase_price'].sum().reset_index()
-    for col in ['year','month']:
-        data[col] = data[col].apply(lambda x: str(x))
-    data['idx'] = data.year.str.cat(data.month, sep='-')
-    data.set_index('idx', inplace=True)
-    data = data['purchase_price']
-    # print(len(data))
-    
-    # Fill in any blanks in index
-    reqd_indices = index_list(purchase_data)
-    months = list(range(1,42))
-    months_needed = [x for x in reqd_indices if x not in list(data.index)]
+    as_of = date.today() if as_of is None else as_of
+    key = (data_version, as_of)
+    if (data_version is not None) and (key in kpi_cache):
+        return kpi_cache.get(key)
 
-    if len(months_needed) > 0:
-        mths_zeros = np.zeros(len(months_needed))
-        mths_to_add = pd.Series(data=mths_zeros, index=months_needed)
-        data = pd.concat([data, mths_to_add]).sort_index()
+    arrays = kpi_cache.get((data_version, 'arrays')) if data_version is not None else None
+    if arrays is None:
+        arrays = kpi_arrays(purchase_data, opportunity_data)
+        if data_version is not None:
+            kpi_cache.put((data_version, 'arrays'), arrays)
 
-    # If today's date isn't the first, drop any data from this month
-    # to prevent incomplete data from messing with model
-    if date.today().day != 1:
-        data = data[:-1]
+    # Windows are "after the cutoff", so find the first date strictly greater than it
+    cutoff_6m = np.datetime64(pd.to_datetime(as_of + relativedelta(months=-6)))
+    cutoff_12m = np.datetime64(pd.to_datetime(as_of + relativedelta(months=-12)))
+    pur_start = np.searchsorted(arrays['purchased'], cutoff_6m, side='right')
+    opp_start_6m, opp_start_12m = np.searchsorted(arrays['created'], [cutoff_6m, cutoff_12m], side='right')
+
+    purchases_6m = len(arrays['purchased']) - pur_start
+    opportunities_6m = len(arrays['created']) - opp_start_6m
+    opportunities_12m = len(arrays['created']) - opp_start_12m
+
+    cycle_count = arrays['cycle_count'][-1] - arrays['cycle_count'][pur_start]
+    cycle_days = arrays['cycle_days'][-1] - arrays['cycle_days'][pur_start]
+
+    kpis = {'purchase_count' : int(purchases_6m),
+            'opportunity_count' : int(purchases_6m + opportunities_6m),
+            'win_rate' : purchases_6m / (purchases_6m + opportunities_12m) if (purchases_6m + opportunities_12m) > 0 else 0.0,
+            'avg_sales_cycle' : int(np.floor(cycle_days / cycle_count)) if cycle_count > 0 else 0}
+
+    if data_version is not None:
+        kpi_cache.put(key, kpis)
+    return kpis
+
+def monthly_totals(cube, measure):
+    """ Month-by-month totals of the monthly cube, keeping only the months that have any `measure`
+    (the same months a groupby over the raw rows would give).
+    Arguments:
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, optionally filtered on make/model
+    measure (str) -- count measure that must be non-zero, 'purchase_count' or 'opportunity_count'
+
+    Returns:
+    totals (DataFrame) -- year, month and the summed cube measures, sorted by year/month
+    """
+    totals = cube.groupby(['year', 'month'])[tools.CUBE_MEASURES].sum().reset_index()
+    return totals[totals[measure] > 0].reset_index(drop=True)
+
+def monthly_calendar(cube, measure, start=None, end=None):
+    """ Month-by-month totals of the monthly cube on a complete monthly calendar: every month from
+    the first to the last month with any `measure` (or from start to end), with 0 for the months
+    that have none. The index is a PeriodIndex, so the months sort and slice in calendar order.
+    Arguments:
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, optionally filtered on make/model
+    measure (str) -- count measure that must be non-zero, 'purchase_count' or 'opportunity_count'
+    start (Period) -- first month of the calendar, defaults to the first month with any `measure`
+    end (Period) -- last month of the calendar, defaults to the last month with any `measure`
+
+    Returns:
+    totals (DataFrame) -- the summed cube measures, indexed by month
+    """
+    totals = monthly_totals(cube, measure)
+    months = pd.PeriodIndex(year=totals['year'], month=totals['month'], freq='M')
+    totals = totals[tools.CUBE_MEASURES].set_axis(months)
+    if len(totals) == 0 and (start is None or end is None):
+        return totals
+    start = months.min() if start is None else start
+    end = months.max() if end is None else end
+    return totals.reindex(pd.period_range(start, end, freq='M'), fill_value=0)
+
+def last_complete_month(data_end=None):
+    """ Last month of sales that is over, the month forecasts are fit up to. The month of the latest
+    purchase only counts if that purchase was on its last day, and the current month never does.
+    Arguments:
+    data_end (Timestamp) -- date of the latest purchase in the data (not just the filtered make/model), defaults to today
+
+    Returns:
+    month (Period)
+    """
+    this_mth = pd.Period(date.today(), 'M')
+    if data_end is None or pd.isna(data_end):
+        return this_mth - 1
+    data_end = pd.Timestamp(data_end)
+    last = pd.Period(data_end, 'M')
+    return min(last if data_end.is_month_end else last - 1, this_mth - 1)
+
+def index_list(cube):
+    """ Gets index list of month/year combinations
+    Arguments:
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, optionally filtered on make/model
+
+    Returns:
+    index list (list) -- List of year/month combinations ('YYYY-MM'), every month from the first to the last sale
+    """
+    return list(monthly_calendar(cube, 'purchase_count').index.strftime('%Y-%m'))
+
+def arima_predictions(cube, ci=0.05, start_params=None, return_params=False, data_end=None, fit=True):
+    """ Predict sales for 6 months out with confidence interval using past purchase data.
+    Arguments:
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, optionally filtered on make/model
+    ci (float) -- alpha of the confidence interval
+    start_params (list) -- parameters to start the fit from, e.g. those of an earlier fit of the same series
+    return_params (bool) -- also return the fitted parameters
+    data_end (Timestamp) -- date of the latest purchase in the data, see last_complete_month
+    fit (bool) -- fit the model; if False, forecast with start_params as they are (an earlier fit of the same data)
+
+    Returns:
+    arima_preds (DataFrame) -- arima predictions with confidence interval.
+    params (list) -- fitted parameters, if return_params is set
+    """
+    # Monthly sales up to the last complete month, with the months without any as 0. A partial
+    # last month (the data ends mid month, or it is this month) would drag the forecast down
+    end = last_complete_month(data_end)
+    data = monthly_calendar(cube, 'purchase_count', end=end)['revenue'].rename('purchase_price')
 
     arima = ARIMA(data, order=(1,0,3))
-    model = arima.fit()
+    model = arima.fit(start_params=start_params) if fit else arima.filter(start_params)
     forecast = model.get_forecast(steps=3)
     preds_mean = forecast.predicted_mean
     preds_ci = forecast.conf_int(alpha=ci)
@@ -135,4 +251,47 @@ def arima_predictions(purchase_data, ci=0.05):
                           'upper purchase_price':'prediction_upper_bound'}, 
                  inplace=True)
 
-    return preds
\ No newline at end of file
+    if return_params:
+        return preds, [float(x) for x in model.params]
+    return preds
+
+
+def box_stats(data, by, value):
+    """ Box plot statistics per category, as plotly computes them: linear interpolated quartiles,
+    whiskers out to the furthest point within 1.5 IQR of the box.
+    Arguments:
+    data (DataFrame) -- rows to summarize
+    by (str) -- category column
+    value (str) -- value column
+
+    Returns:
+    stats (DataFrame) -- q1, median, q3, lowerfence, upperfence, indexed by category (sorted)
+    """
+    grouped = data.groupby(by, observed=True)[value]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack().sort_index()
+    stats.columns = ['q1', 'median', 'q3']
+
+    # Whiskers: the most extreme values still inside the fences
+    iqr = stats['q3'] - stats['q1']
+    low = data[by].map(stats['q1'] - 1.5 * iqr).astype(float)
+    high = data[by].map(stats['q3'] + 1.5 * iqr).astype(float)
+    inside = data[(data[value] >= low) & (data[value] <= high)].groupby(by, observed=True)[value]
+    stats['lowerfence'] = inside.min()
+    stats['upperfence'] = inside.max()
+    return stats
+
+
+def stratified_sample(data, by, n, seed=0):
+    """ Random sample of up to n rows per category, in the original row order.
+    Arguments:
+    data (DataFrame) -- rows to sample
+    by (str) -- category column
+    n (int) -- most rows kept per category
+    seed (int) -- random seed, fixed so the same data always gives the same sample
+
+    Returns:
+    sample (DataFrame)
+    """
+    rng = np.random.default_rng(seed)
+    rank = pd.Series(rng.random(len(data)), index=data.index).groupby(data[by], observed=True).rank(method='first')
+    return data[rank <= n]
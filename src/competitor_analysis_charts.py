@@ -1,6 +1,51 @@
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
+import chart_functions
+import quantile_sketch
+
+def price_boxes(data_c, by, **px_args):
+    """ Box plots of competitor prices by make/model. Above chart_functions.AGGREGATE_ROWS rows,
+    only the box statistics are sent to the browser instead of every price (outliers aren't drawn).
+    Arguments:
+    data_c (DataFrame) -- competitor data
+    by (str) -- category column, car_make or car_model
+    px_args -- other arguments to px.box
+
+    Returns:
+    chart figure
+    """
+    if len(data_c) <= chart_functions.AGGREGATE_ROWS:
+        return px.box(data_c, x=by, y='purchase_price', color_discrete_sequence=["#4287F5"], **px_args)
+
+    stats = chart_functions.box_stats(data_c, by, 'purchase_price')
+    fig_boxes = go.Figure(go.Box(x=stats.index.astype(str), q1=stats['q1'], median=stats['median'], q3=stats['q3'],
+                                 lowerfence=stats['lowerfence'], upperfence=stats['upperfence'],
+                                 marker_color="#4287F5", name=''),
+                          layout=dict(boxmode='group', margin=dict(t=60)))
+    fig_boxes.update_layout(**{k : v for k, v in px_args.items() if k == 'title'})
+    return fig_boxes
+
+
+def company_average_overlay(fig_boxes, company_avgs):
+    """ Draw the company average of each make/model as a line across its box. All the lines go
+    in one trace, separated by gaps, so the figure doesn't grow a trace per category.
+    Arguments:
+    fig_boxes (Figure) -- box plot figure to draw on
+    company_avgs (array) -- company average price of each category, in the boxes' order
+    """
+    n = len(company_avgs)
+    fig_boxes.layout.xaxis2 = go.layout.XAxis(overlaying='x', range=[0,n], showticklabels=False)
+
+    # Segment i runs from i to i+1 at the i-th average, then a gap (None) before the next
+    x = np.empty((n, 3), dtype=object)
+    x[:, 0], x[:, 1], x[:, 2] = np.arange(n), np.arange(1, n+1), None
+    y = np.empty((n, 3), dtype=object)
+    y[:, 0], y[:, 1], y[:, 2] = company_avgs, company_avgs, None
+    fig_boxes.add_scatter(x=x.ravel(), y=y.ravel(), mode='lines', xaxis='x2', connectgaps=False,
+                          showlegend=False, line={'color':'#993729', 'width':2})
+
 
 def competitor_box_plots(make_value, model_value, data_c, data_p):
     """ Box plots of company avg against competitor IQR, distribution breakdown by make/model
@@ -15,66 +60,80 @@ def competitor_box_plots(make_value, model_value, data_c, data_p):
     """
     if ((make_value is None) and (model_value is None)) | ((make_value is None) and (model_value is not None)):
         # If no make value is chosen, segment by make
-        fig_boxes = px.box(data_c, x='car_make', y='purchase_price', title='Price Comparison by Make',
-                            color_discrete_sequence=["#4287F5"], labels={'car_make':'Car Make'})
+        fig_boxes = price_boxes(data_c, 'car_make', title='Price Comparison by Make', labels={'car_make':'Car Make'})
         fig_boxes.update_xaxes(categoryorder='category ascending')
 
-        company_avgs = data_p.groupby('car_make')['purchase_price'].mean()
-        x2 = company_avgs.index
-        company_avgs = company_avgs.values
-
-        fig_boxes.layout.xaxis2 = go.layout.XAxis(overlaying='x', range=[0,len(x2)], showticklabels=False)
-
-        for i in range(len(x2)):
-            bargap = 0.1
-            x = [i, i+1]
-            y = [company_avgs[i], company_avgs[i]]
-            scatt = fig_boxes.add_scatter(x=x, y=y, mode='lines', xaxis='x2', 
-                                            showlegend=False, line={'color':'#993729', 'width':2})
+        company_avgs = data_p.groupby('car_make', observed=True)['purchase_price'].mean().sort_index()
+        company_average_overlay(fig_boxes, company_avgs.values)
 
         fig_boxes.update_layout(title_text='Price Comparison by Model', title_x = 0.5, 
                                 xaxis_title='Car Model', yaxis_title='Average Price', showlegend=False)
 
     else:
         # If make value chosen, segment by model
-        fig_boxes = px.box(data_c, x='car_model', y='purchase_price', color_discrete_sequence=["#4287F5"], )
+        fig_boxes = price_boxes(data_c, 'car_model')
         fig_boxes.update_xaxes(categoryorder='category ascending')
 
-        company_avgs = data_p.groupby('car_model')['purchase_price'].mean()
-        x2 = company_avgs.index
-        company_avgs = company_avgs.values
-
-        fig_boxes.layout.xaxis2 = go.layout.XAxis(overlaying='x', range=[0,len(x2)], showticklabels=False)
-
-        for i in range(len(x2)):
-            bargap = 0.1
+        company_avgs = data_p.groupby('car_model', observed=True)['purchase_price'].mean().sort_index()
+        company_average_overlay(fig_boxes, company_avgs.values)
 
-            x = [i, i+1]
-            y = [company_avgs[i], company_avgs[i]]
-            scatt = fig_boxes.add_scatter(x=x, y=y, mode='lines', xaxis='x2', 
-                                            showlegend=False, line={'color':'#993729', 'width':2})
-        
         fig_boxes.update_layout(title_text='Price Comparison by Make', title_x = 0.5, 
                                 xaxis_title='Car Make', yaxis_title='Average Price', showlegend=False)
 
     return fig_boxes
 
 
-def pricing_deltas_list(competitor_meds, purchase_avgs):
-    """ Table of highest differences from company average to competitor median.
+def pricing_delta_table(competitor_meds, purchase_avgs):
+    """ Differences from company average to competitor median, sorted by opportunity cost
+    (most negative, i.e. the biggest shortfall against competitors, first).
     Arguments:
     competitor_meds (DataFrame) -- dataframe of competitor medians, by make/model
-    purchase_avgs (DataFrame) -- dataframe of company averages, by make/model
+    purchase_avgs (DataFrame) -- dataframe of company averages and purchase counts, by make/model
 
     Returns:
-    chart figure
+    pricing deltas (DataFrame) -- Competitor Median, Average Price, Count, Pricing Delta ($), Pricing Delta (%)
+                                  and Opportunity Cost, by the make/model both have
     """
     pricing_deltas = pd.concat([competitor_meds, purchase_avgs], axis=1, join='inner', ignore_index=False)
     pricing_deltas['pricing_delta'] = pricing_deltas['Average Price'] - pricing_deltas['Competitor Median']
     pricing_deltas['pricing_delta_pct'] = pricing_deltas['Average Price'] / pricing_deltas['Competitor Median'] - 1
     pricing_deltas['Opportunity Cost'] = pricing_deltas['pricing_delta'] * pricing_deltas['Count']
     pricing_deltas.sort_values('Opportunity Cost', ascending=True, inplace=True)
-    pricing_deltas = pricing_deltas.rename(columns={'pricing_delta_pct' : 'Pricing Delta (%)', 'pricing_delta' : 'Pricing Delta ($)'}).head(10)
+    return pricing_deltas.rename(columns={'pricing_delta_pct' : 'Pricing Delta (%)', 'pricing_delta' : 'Pricing Delta ($)'})
+
+
+def pricing_delta_tables(monthly_cube, sketches):
+    """ Pricing delta tables by make and by model, built from the already aggregated data:
+    company averages from the monthly cube and competitor medians from the price sketches.
+    Both are kept up to date incrementally as batches are ingested, so the tables only cost
+    a pass over a few hundred makes/models per data version.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    sketches (dict) -- competitor price sketches from quantile_sketch.load_sketches
+
+    Returns:
+    tables (dict) -- 'car_make'/'car_model' -> pricing deltas (see pricing_delta_table)
+    """
+    tables = {}
+    for dimension in ['car_make', 'car_model']:
+        competitor_meds = pd.DataFrame(quantile_sketch.sketch_medians(sketches, dimension)).rename(columns={'purchase_price':'Competitor Median'})
+        totals = monthly_cube.groupby(dimension, observed=True)[['revenue', 'purchase_count']].sum().sort_index()
+        totals = totals[totals['purchase_count'] > 0] # Makes/models only seen in opportunities
+        purchase_avgs = pd.DataFrame({'Average Price' : totals['revenue'] / totals['purchase_count'], 'Count' : totals['purchase_count']})
+        tables[dimension] = pricing_delta_table(competitor_meds, purchase_avgs)
+    return tables
+
+
+def pricing_deltas_list(pricing_deltas, n=10):
+    """ Table of highest differences from company average to competitor median.
+    Arguments:
+    pricing_deltas (DataFrame) -- pricing deltas, sorted (see pricing_delta_table)
+    n (int) -- number of rows to show
+
+    Returns:
+    chart figure
+    """
+    pricing_deltas = pricing_deltas.head(n).copy()
 
     for col in ['Average Price', 'Competitor Median', 'Pricing Delta ($)', 'Opportunity Cost']:
         pricing_deltas[col] = pricing_deltas[col].apply(lambda x: f"${x/1000:,.0f}k")
@@ -85,21 +144,20 @@ def pricing_deltas_list(competitor_meds, purchase_avgs):
     return pricing_deltas
 
 
-def benchmarking_chart(competitors, purchases):
+def benchmarking_chart(competitors, purchases, sketches=None):
     """ Benchmarking chart comparing company prices to competitor prices, by tiers
     Arguments:
     purchases (DataFrame) -- purchase data previously loaded in from csv, filtered by make/model
     competitors (DataFrame) -- competitor data previously loaded in from csv, filtered by make/model
+    sketches (dict) -- competitor price sketches (quantile_sketch.load_sketches), built from competitors if not given
 
     Returns:
     chart figure
     """
-    c_tmp = competitors.groupby('car_tier')['purchase_price'].quantile([0.25, 0.5, 0.75, 0.9]).reset_index()
-    c_tmp = c_tmp.rename(columns={'level_1' : 'percentile'})
-    c_tmp = pd.pivot_table(c_tmp, values='purchase_price', index='car_tier', columns='percentile')
-    c_tmp.columns = [str(x) for x in c_tmp.columns]
+    sketches = quantile_sketch.build_sketches(competitors) if sketches is None else sketches
+    c_tmp = quantile_sketch.sketch_quantiles(sketches, 'car_tier', [0.25, 0.5, 0.75, 0.9])
     
-    p_tmp = purchases.groupby('car_tier')['purchase_price'].mean()
+    p_tmp = purchases.groupby('car_tier', observed=True)['purchase_price'].mean().sort_index()
 
     x = c_tmp.index
     fig_line = go.Figure()
@@ -3,6 +3,10 @@ import pandas as pd
 import numpy as np
 import os, sys
 import random
+import argparse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 
 """
 This is a single-use script for creating the overall datasets.
@@ -10,162 +14,348 @@ This is a single-use script for creating the overall datasets.
 This includes collating Mockaroo datasets, generating financial dataset,
 making some formatting edits to all datasets, and re-saving them in
 the proper format to feed into the app.py file.
+
+Run with --stream to read the raw files in chunks and write the datasets
+out as it goes, for raw exports that are too large to hold in memory, and
+with --workers N to read and clean the raw files in N parallel processes.
+
+The collating and cleaning steps are also used by ingest.py to clean new
+batches of data before appending them to the datasets.
 """
 
 
 path = os.path.dirname(os.getcwd()) + '/assets'
 
-# Collate purchases
-purchases = pd.DataFrame()
-for file in [x for x in os.listdir(path+'/raw_purchases_data') if x.startswith('purchase')]:
-    # f = os.path.join(path, file)
-    df = pd.read_csv(path + '/raw_purchases_data/' + file, index_col='id')
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    purchases = pd.concat([purchases,df], axis=0).reset_index(drop=True)
+# Dataset name -> (raw data directory, raw file name prefix)
+RAW_DATA = {'purchases' : ('raw_purchases_data', 'purchase'),
+            'competitors' : ('raw_competitor_data', 'competitor'),
+            'opportunities' : ('raw_opportunities_data', 'opportunities')}
 
+TIERS = ['Budget', 'Economy', 'Off-Road', 'Sports', 'Luxury']
 
-# Collate competitors
-competitors = pd.DataFrame()
-for file in [x for x in os.listdir(path+'/raw_competitor_data') if x.startswith('competitor')]:
-    # f = os.path.join(path, file)
-    df = pd.read_csv(path + '/raw_competitor_data/' + file, index_col='id')
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    competitors = pd.concat([competitors,df], axis=0).reset_index(drop=True)
+# Rows per chunk when streaming
+CHUNKSIZE = 100000
+
+# Income statement line items, in the order simulate_financials produces them
+FINANCIAL_LINE_ITEMS = ['car_sales_revenues', 'rental_revenues', 'financing_revenues', 'total_revenue',
+                        'cost_goods_sold', 'gross_margin', 'marketing', 'other_opex',
+                        'operating_expenses', 'operating_income', 'tax_expense', 'net_income']
 
-# Collate opportunitites
-opportunities = pd.DataFrame()
-for file in [x for x in os.listdir(path+'/raw_opportunities_data') if x.startswith('opportunities')]:
-    # f = os.path.join(path, file)
-    df = pd.read_csv(path + '/raw_opportunities_data/' + file, index_col='id')
+
+def read_raw_file(file_path):
+    """ Read a single raw Mockaroo export.
+    Arguments:
+    file_path (str) -- path to the raw csv file
+
+    Returns:
+    df (DataFrame) -- raw data, without the unnamed filler columns
+    """
+    df = pd.read_csv(file_path, index_col='id')
     df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-    opportunities= pd.concat([opportunities,df], axis=0).reset_index(drop=True)
+    return df
+
+
+def raw_files(name):
+    """ Raw files for a dataset, in file name order.
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+
+    Returns:
+    files (list) -- paths of the raw csv files
+    """
+    directory, prefix = RAW_DATA[name]
+    return [path + '/' + directory + '/' + file for file in sorted(os.listdir(path + '/' + directory)) if file.startswith(prefix)]
+
+
+def collate(name):
+    """ Collate all of the raw files for a dataset.
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+
+    Returns:
+    df (DataFrame) -- raw data from every file
+    """
+    files = raw_files(name)
+    if len(files) == 0:
+        return pd.DataFrame()
+    return pd.concat([read_raw_file(file) for file in files], axis=0).reset_index(drop=True)
+
+
+def stream_clean(name, chunksize=CHUNKSIZE):
+    """ Read and clean the raw files for a dataset in chunks of at most `chunksize` rows.
+    Chunks are indexed continuously across files, the same as collate.
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+    chunksize (int) -- maximum rows per chunk
+
+    Yields:
+    chunk (DataFrame) -- cleaned chunk of data
+    """
+    offset = 0
+    for file in raw_files(name):
+        for chunk in pd.read_csv(file, index_col='id', chunksize=chunksize):
+            chunk = chunk.loc[:, ~chunk.columns.str.contains('^Unnamed')]
+            chunk = clean_raw(name, chunk)
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+
+
+def clean_raw_file(name, file_path, chunksize=None):
+    """ Read and clean a single raw file (process pool entry point for parallel_clean).
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+    file_path (str) -- path to the raw csv file
+    chunksize (int) -- read and clean the file this many rows at a time, None to read it all at once
+
+    Returns:
+    chunks (list) -- cleaned data from the file, one DataFrame per chunk read
+    """
+    if chunksize is None:
+        return [clean_raw(name, read_raw_file(file_path))]
+    return [clean_raw(name, chunk.loc[:, ~chunk.columns.str.contains('^Unnamed')])
+            for chunk in pd.read_csv(file_path, index_col='id', chunksize=chunksize)]
+
+
+def parallel_clean(name, pool, workers, chunksize=None):
+    """ Read and clean the raw files for a dataset in a process pool. At most `workers` files are
+    in the pool at once, the next one going in as each result is handed back, so only a few
+    files are ever held in memory. Results come back in file name order and are indexed
+    continuously, the same as collate.
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+    pool (ProcessPoolExecutor) -- pool to run in, see make_pool
+    workers (int) -- number of files to keep in the pool
+    chunksize (int) -- rows per chunk the workers read and clean, None for whole files
+
+    Yields:
+    chunk (DataFrame) -- cleaned chunk of data (a whole raw file without chunksize)
+    """
+    files = iter(raw_files(name))
+    in_flight = deque(pool.submit(clean_raw_file, name, file, chunksize) for file in islice(files, workers))
+    offset = 0
+    while in_flight:
+        chunks = in_flight.popleft().result()
+        for file in islice(files, 1):
+            in_flight.append(pool.submit(clean_raw_file, name, file, chunksize))
+        for df in chunks:
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            offset += len(df)
+            yield df
+
+
+def make_pool(workers):
+    """ Process pool for parallel_clean. Each worker gets its own random seed, otherwise
+    forked workers would all assign the same "random" tiers and years.
+    Arguments:
+    workers (int) -- number of worker processes
+
+    Returns:
+    pool (ProcessPoolExecutor)
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=random.seed)
 
 
-### Assign tiers
-tiers = ['Budget', 'Economy', 'Off-Road', 'Sports', 'Luxury']
-purchases['car_tier'] = random.choices(tiers, k=len(purchases))
-competitors['car_tier'] = random.choices(tiers, k=len(competitors))
+def write_streaming(chunks, out_file):
+    """ Write chunks of a dataset to a csv as they arrive. Columns follow the first chunk,
+    so a raw file with extra columns can't shift the others.
+    Arguments:
+    chunks (iterable) -- chunks of data, e.g. from stream_clean
+    out_file (str) -- path of the csv to write
+
+    Returns:
+    rows (int) -- number of rows written
+    """
+    rows = 0
+    columns = None
+    with open(out_file, 'w', newline='') as f:
+        for chunk in chunks:
+            if columns is None:
+                columns = chunk.columns
+            chunk.reindex(columns=columns).to_csv(f, header=(rows == 0))
+            rows += len(chunk)
+    return rows
+
+
+def clean_raw(name, df):
+    """ Make the formatting edits Mockaroo would not do for us: assign tiers, clean up
+    financing and replace any car years before 2010.
+    Arguments:
+    name (str) -- dataset name, one of RAW_DATA
+    df (DataFrame) -- raw data
+
+    Returns:
+    df (DataFrame) -- cleaned data
+    """
+    ### Assign tiers
+    if name in ['purchases', 'competitors']:
+        df['car_tier'] = random.choices(TIERS, k=len(df))
 
-# Clean up financing in Opportunities/Purchases
-random_pcts = [random.uniform(0, 0.95) for x in range(len(opportunities))]
-opportunities['pct_financed'] = np.where(opportunities['financing_reqd'] == False, 0, random_pcts)
-purchases['pct_financed'] = np.where(purchases['pct_financed'] == False, 0, purchases['pct_financed'])
+    # Clean up financing in Opportunities/Purchases
+    if name == 'opportunities':
+        random_pcts = [random.uniform(0, 0.95) for x in range(len(df))]
+        df['pct_financed'] = np.where(df['financing_reqd'] == False, 0, random_pcts)
+    elif name == 'purchases':
+        df['pct_financed'] = np.where(df['pct_financed'] == False, 0, df['pct_financed'])
 
-# Clean up all car years - nothing less than 2010
-random_yr = [random.randint(2010,2023) for x in range(5000)]
-purchases['car_year'] = np.where(purchases['car_year'] >= 2010, purchases['car_year'], random_yr[:len(purchases)])
-opportunities['car_year'] = np.where(opportunities['car_year_interest'] >= 2010, opportunities['car_year_interest'], random_yr[:len(opportunities)])
-competitors['car_year'] = np.where(competitors['car_year'] >= 2010, competitors['car_year'], random_yr[:len(competitors)])
+    # Clean up all car years - nothing less than 2010
+    random_yr = [random.randint(2010,2023) for x in range(len(df))]
+    year_col = 'car_year_interest' if name == 'opportunities' else 'car_year'
+    df['car_year'] = np.where(df[year_col] >= 2010, df[year_col], random_yr)
 
-def generate_financials():
+    return df
+
+
+def car_sales_start(purchases):
+    """ Car sales in the latest quarter (2023 Q1), which the generated financials grow back from.
+    Arguments:
+    purchases (DataFrame) -- collated purchase data (or a chunk of it)
+
+    Returns:
+    car sales (float) -- total purchase price in 2023 Q1
+    """
+    return purchases[(purchases['date_purchased'] >= '2023-01-01') & (purchases['date_purchased'] < '2023-04-01')]['purchase_price'].sum()
+
+
+def financial_quarters():
+    """ Quarters the financials cover, oldest first.
+    Returns:
+    quarters (list) -- 'YYYY_qN' column names, 2018_q1 through 2023_q1
+    """
+    return [f'{y}_q{q}' for y in range(2018, 2023) for q in range(1, 5)] + ['2023_q1']
+
+
+def random_walk(rng, start, low, high, steps):
+    """ Walk each scenario back from its starting (latest) value with uniform quarterly growth.
+    Arguments:
+    rng (Generator) -- numpy random generator
+    start (array) -- latest value, one per scenario
+    low (float) -- lowest quarterly growth rate
+    high (float) -- highest quarterly growth rate
+    steps (int) -- number of quarters, including the latest
+
+    Returns:
+    values (array) -- scenarios x quarters, oldest quarter first
+    """
+    growth = 1 + rng.uniform(low, high, size=(len(start), steps - 1))
+    walk = np.cumprod(np.concatenate([np.ones((len(start), 1)), growth], axis=1), axis=1)
+    return np.round(start[:, None] * walk, 2)[:, ::-1]
+
+
+def simulate_financials(cars_start, n_scenarios=1, seed=None):
+    """ Monte-Carlo income statements. Every line item of every quarter of every scenario is
+    drawn at once, from a seeded generator so that runs can be reproduced.
+    Arguments:
+    cars_start (float) -- car sales in the latest quarter, from car_sales_start
+    n_scenarios (int) -- number of income statements to simulate
+    seed (int) -- random seed, None for a fresh one each call
+
+    Returns:
+    scenarios (array) -- scenarios x line items (FINANCIAL_LINE_ITEMS) x quarters (financial_quarters)
+    """
+    rng = np.random.default_rng(seed)
+    n = n_scenarios
+    steps = len(financial_quarters())
+
+    ## Revenues, walked back from the latest quarter
+    car_revs = random_walk(rng, np.full(n, float(cars_start)), -0.025, 0.045, steps)
+    rental_revs = random_walk(rng, rng.integers(5000000, 6000000, size=n, endpoint=True).astype(float), -0.015, 0.035, steps)
+    financing_revs = random_walk(rng, rng.integers(2000000, 3000000, size=n, endpoint=True).astype(float), -0.015, 0.025, steps)
+    total_revs = car_revs + rental_revs + financing_revs
+
+    ## COGS and gross margin
+    cogs = random_walk(rng, total_revs[:, -1] * 0.61, -0.05, 0.05, steps)
+    gross_margin = total_revs - cogs
+
+    ## Operating expenses, of which marketing
+    opex = random_walk(rng, gross_margin[:, -1] * 0.25, -0.04, 0.04, steps)
+    marketing = random_walk(rng, opex[:, -1] * 0.25, -0.1, 0.1, steps)
+    other_opex = opex - marketing
+    op_income = gross_margin - opex
+
+    ## Tax expense and net income (tax runs off the op-ex in reverse quarter order, as it always has)
+    tx_ex = np.round(opex * (1 + rng.uniform(0.08, 0.18, size=opex.shape)), 2)[:, ::-1]
+    net_income = op_income - tx_ex
+
+    return np.stack([car_revs, rental_revs, financing_revs, total_revs, cogs, gross_margin,
+                     marketing, other_opex, opex, op_income, tx_ex, net_income], axis=1)
+
+
+def financials_frame(scenario):
+    """ One simulated scenario as a financials dataframe.
+    Arguments:
+    scenario (array) -- line items x quarters, one scenario from simulate_financials
+
+    Returns:
+    financials (DataFrame) -- dataframe of financials with quarters in columns, line items as rows/index
+    """
+    return pd.DataFrame(data=scenario, index=FINANCIAL_LINE_ITEMS, columns=financial_quarters())
+
+
+def generate_financials(cars_start, seed=None):
     """ This code generates the financials dataset.
+    Arguments:
+    cars_start (float) -- car sales in the latest quarter, from car_sales_start
+    seed (int) -- random seed, None for a fresh one each run
+
     Returns:
     financials (DataFrame) -- dataframe of financials with quarters in columns, line items as rows/index
     """
+    return financials_frame(simulate_financials(cars_start, n_scenarios=1, seed=seed)[0])
 
-    ### Generate financials
-    years = [*range(2018, 2023, 1)]
-    cols = []
-    for y in years:
-        for i in range(1,5):
-            cols.append(str(y) + '_q' + str(i))
-    cols.append('2023_q1')
-
-    ## Calculate revenues
-    cars_start = purchases[(purchases['date_purchased'] >= '2023-01-01') & (purchases['date_purchased'] < '2023-04-01')]['purchase_price'].sum()
-    rental_services_start = random.randint(5000000,6000000)
-    driving_services_start = random.randint(2000000,3000000)
-
-    # Calculate car_sales
-    car_revs = [cars_start]
-    for x in range(len(cols)-1):
-        new = car_revs[-1] * (1 + random.uniform(-0.025, 0.045))
-        car_revs.append(round(new,2))
-    car_revs = car_revs[::-1]
-
-    # Calculate rental rev
-    rental_revs = [rental_services_start]
-    for x in range(len(cols)-1):
-        new = rental_revs[-1] * (1 + random.uniform(-0.015, 0.035))
-        rental_revs.append(round(new,2))
-    rental_revs = rental_revs[::-1]
-
-    # Calculate driving services rev
-    financing_revs = [driving_services_start]
-    for x in range(len(cols)-1):
-        new = financing_revs[-1] * (1 + random.uniform(-0.015, 0.025))
-        financing_revs.append(round(new,2))
-    financing_revs = financing_revs[::-1]
-
-    ## Calculate total revs
-    total_revs = np.add(np.array(car_revs), np.array(rental_revs))
-    total_revs = np.add(np.array(total_revs), np.array(financing_revs))
-
-    ## Calculate COGS
-    start = total_revs[-1] * 0.61
-    cogs = [start]
-    for x in range(len(cols)-1):
-        new = cogs[-1] * (1 + random.uniform(-0.05, 0.05))
-        cogs.append(round(new,2))
-    cogs = cogs[::-1]
-
-    ## Gross Margin
-    gross_margin = np.subtract(np.array(total_revs), np.array(cogs))
-
-    ## Operating Expenses
-    start = gross_margin[-1] * 0.25
-    opex = [start]
-    for x in range(len(cols)-1):
-        new = opex[-1] * (1 + random.uniform(-0.04, 0.04))
-        opex.append(round(new,2))
-    opex = opex[::-1]
-
-    ## Marketing Expenses
-    start = opex[-1] * 0.25
-    marketing = [start]
-    for x in range(len(cols)-1):
-        new = marketing[-1] * (1 + random.uniform(-0.1, 0.1))
-        marketing.append(round(new,2))
-    marketing = marketing[::-1]
-
-    ## Other Op-ex Expenses
-    other_opex = np.subtract(np.array(opex), np.array(marketing))
-
-    ## Operating Income
-    op_income = np.subtract(np.array(gross_margin), np.array(opex))
-
-    ## Tax Expense
-    tx_ex = []
-    for x in range(len(cols)):
-        new = opex[x] * (1 + random.uniform(0.08, 0.18))
-        tx_ex.append(round(new,2))
-    tx_ex = tx_ex[::-1]
-
-    ## Net Income
-    net_income = np.subtract(np.array(op_income), np.array(tx_ex))
-
-    data = {'car_sales_revenues' : car_revs,
-            'rental_revenues' : rental_revs,
-            'financing_revenues' : financing_revs,
-            'total_revenue' : total_revs,
-            'cost_goods_sold' : cogs,
-            'gross_margin' : gross_margin,
-            'marketing' : marketing,
-            'other_opex' : other_opex,
-            'operating_expenses' : opex,
-            'operating_income' : op_income,
-            'tax_expense' : tx_ex,
-            'net_income' : net_income
-            }
-
-    financials = pd.DataFrame(data=data, index=cols).T
-    return financials
-
-financials = generate_financials()
-
-purchases.to_csv(path + '/' + 'purchases.csv')
-opportunities.to_csv(path + '/' + 'opportunities.csv')
-competitors.to_csv(path + '/' + 'competitor_data.csv')
-financials.to_csv(path + '/' + 'financials.csv')
+
+def main(stream=False, chunksize=CHUNKSIZE, workers=1, seed=None):
+    """ Collate and clean all of the raw data, generate the financials, and save the datasets.
+    Arguments:
+    stream (bool) -- write the datasets out a chunk at a time instead of all at once
+    chunksize (int) -- maximum rows per chunk when streaming
+    workers (int) -- number of processes to read and clean the raw files in, 1 to stay in this process
+    seed (int) -- random seed for the generated financials
+    """
+    pool = make_pool(workers) if workers > 1 else None
+    if pool is not None:
+        chunks = {name : parallel_clean(name, pool, workers, chunksize if stream else None) for name in RAW_DATA}
+    elif stream:
+        chunks = {name : stream_clean(name, chunksize) for name in RAW_DATA}
+    else:
+        chunks = {name : [clean_raw(name, collate(name))] for name in RAW_DATA}
+
+    if stream:
+        # Keep a running total of the car sales the financials need as the purchases go by
+        car_sales = []
+        def track_car_sales(chunks):
+            for chunk in chunks:
+                car_sales.append(car_sales_start(chunk))
+                yield chunk
+
+        write_streaming(track_car_sales(chunks['purchases']), path + '/' + 'purchases.csv')
+        write_streaming(chunks['opportunities'], path + '/' + 'opportunities.csv')
+        write_streaming(chunks['competitors'], path + '/' + 'competitor_data.csv')
+        financials = generate_financials(sum(car_sales), seed=seed)
+
+    else:
+        purchases = pd.concat(chunks['purchases'])
+        competitors = pd.concat(chunks['competitors'])
+        opportunities = pd.concat(chunks['opportunities'])
+
+        financials = generate_financials(car_sales_start(purchases), seed=seed)
+
+        purchases.to_csv(path + '/' + 'purchases.csv')
+        opportunities.to_csv(path + '/' + 'opportunities.csv')
+        competitors.to_csv(path + '/' + 'competitor_data.csv')
+
+    financials.to_csv(path + '/' + 'financials.csv')
+    if pool is not None:
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collate and clean the raw data into the app's datasets.")
+    parser.add_argument('--stream', action='store_true', help="process the raw files in chunks, for raw exports too large for memory")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help="rows per chunk when streaming")
+    parser.add_argument('--workers', type=int, default=1, help="processes to read and clean the raw files in")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for the generated financials")
+    args = parser.parse_args()
+    main(stream=args.stream, chunksize=args.chunksize, workers=args.workers, seed=args.seed)
 
 # %%
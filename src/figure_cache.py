@@ -0,0 +1,70 @@
+import os
+import json
+import time
+import threading
+from datetime import date
+from collections import defaultdict
+import tools
+import metrics
+
+"""
+Building a plotly figure (validating every property) and serializing it often costs more
+than the pandas work behind it. Figures are kept here already serialized, as the plain
+JSON structure Dash sends to the browser, per (chart, filter, data version, day). A hit
+skips building the figure entirely.
+
+Hits, misses and the build time saved are counted per chart; see stats().
+"""
+
+FIGURE_CACHE_SIZE = int(os.environ.get('FIGURE_CACHE_SIZE', 256))
+
+figure_store = tools.LRUCache(maxsize=FIGURE_CACHE_SIZE)
+
+_stats = defaultdict(lambda: {'hits' : 0, 'misses' : 0, 'build_seconds' : 0.0, 'seconds_saved' : 0.0})
+_stats_lock = threading.Lock()
+
+
+def cached_figure(chart, filters, data_version, build, *args):
+    """ A chart's figure, as serialized JSON, from the figure store or built and stored.
+    The returned figure is shared with the store, so it must not be modified.
+    Arguments:
+    chart (str) -- name of the chart
+    filters (tuple) -- the filter values the chart's data depends on, e.g. (make, model)
+    data_version (str) -- version of the loaded data (tools.data_version)
+    build (function) -- builds the plotly figure when it isn't stored
+    args -- arguments for build
+
+    Returns:
+    figure (dict) -- figure JSON, to pass to dcc.Graph
+    """
+    # Charts are relative to today (trailing twelve months etc.), so figures only last the day
+    key = (chart, tuple(filters), data_version, date.today().isoformat())
+    hit = figure_store.get(key)
+    if hit is not None:
+        figure, build_seconds = hit
+        with _stats_lock:
+            _stats[chart]['hits'] += 1
+            _stats[chart]['seconds_saved'] += build_seconds
+        return figure
+
+    start = time.perf_counter()
+    with metrics.stage('figure', chart):
+        fig = build(*args)
+    with metrics.stage('serialize', chart):
+        figure = json.loads(fig.to_json())
+    build_seconds = time.perf_counter() - start
+    figure_store.put(key, (figure, build_seconds))
+    with _stats_lock:
+        _stats[chart]['misses'] += 1
+        _stats[chart]['build_seconds'] += build_seconds
+    return figure
+
+
+def stats():
+    """ Hit rate and time saved of the figure store, per chart.
+    Returns:
+    stats (dict) -- chart -> hits, misses, hit_rate, build_seconds (spent on misses) and seconds_saved
+    """
+    with _stats_lock:
+        return {chart : dict(s, hit_rate=s['hits'] / (s['hits'] + s['misses']))
+                for chart, s in _stats.items()}
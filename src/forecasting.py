@@ -0,0 +1,480 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, parent_process
+from datetime import date
+from statistics import NormalDist
+from warnings import catch_warnings, filterwarnings
+import numpy as np
+import pandas as pd
+import chart_functions
+import tools
+import metrics
+
+"""
+Fitting the ARIMA model behind the Sales Metrics forecast is by far the slowest
+part of rendering the dashboard, so fitted forecasts are kept in an LRU store keyed by
+(make, model, data version, ci, as-of month). A failed fit (too little data for the
+filter) is stored as well, so that it is not retried on every render.
+
+ARIMA is only worth its cost for the series most people look at, so the overall series
+and every make and make/model series are also forecast together in one batch
+(batch_forecasts): the monthly revenue of every series is laid out as one matrix and
+Holt's linear exponential smoothing is fit to all of them at once with numpy. The
+FORECAST_ARIMA_SERIES series with the most revenue keep their ARIMA forecast; all the
+others are served from the batch, which also covers sparse series ARIMA can't fit.
+
+The parameters of every ARIMA fit are saved per series in `assets/.cache/arima_params.json`.
+While the data (and as-of month) they were fit on is unchanged they are reused as they are,
+so a restart gives exactly the same forecasts without refitting. Once it changes, the next
+fit of the series starts from them, which converges in a fraction of the iterations when
+the series has only changed a little.
+
+Optionally, the store can be warmed up at startup by running the batch and fitting the
+ARIMA series in a process pool. Set FORECAST_WARMUP=1 (and FORECAST_WARMUP_WORKERS to
+limit the pool size) to turn this on. Running this file refits the series in a process
+pool and saves their parameters, e.g. from a nightly job once a month has closed:
+    python forecasting.py --all --workers 4
+"""
+
+FORECAST_CACHE_SIZE = int(os.environ.get('FORECAST_CACHE_SIZE', 1024))
+
+# Number of series (by revenue) forecast with ARIMA, the rest use the batch forecasts
+FORECAST_ARIMA_SERIES = int(os.environ.get('FORECAST_ARIMA_SERIES', 10))
+
+# Fewest months of sales a series needs for a batch forecast
+MIN_FORECAST_MONTHS = 3
+
+# Smoothing parameters tried for every series, the best fit (one step ahead) is kept
+SMOOTHING_ALPHAS = np.linspace(0.1, 0.9, 9)
+SMOOTHING_BETAS = np.array([0, 0.05, 0.1, 0.2, 0.3])
+
+forecast_store = tools.LRUCache(maxsize=FORECAST_CACHE_SIZE)
+
+# Marks a key missing from the forecast store, where None is a stored failed fit
+_MISSING = object()
+
+# (data version, ci, as of) -> batch forecasts of every series, see batch_forecasts
+batch_store = tools.LRUCache(maxsize=8)
+
+
+def forecast_as_of():
+    """ As-of tag for forecasts. Forecasts are fit up to the last complete month
+    (chart_functions.last_complete_month), which for a given version of the data only
+    changes when the month does.
+    Returns:
+    as of (str) -- 'YYYY-MM'
+    """
+    return date.today().strftime('%Y-%m')
+
+
+def forecast_key(make_value, model_value, data_version, ci):
+    """ Key of a forecast in the store.
+    Arguments:
+    make_value (str) -- make dropdown value
+    model_value (str) -- model dropdown value
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval
+
+    Returns:
+    key (tuple)
+    """
+    return (make_value, model_value, data_version, ci, forecast_as_of())
+
+
+def params_path():
+    """ Path of the saved ARIMA parameters """
+    return tools.cache_path() + "/arima_params.json"
+
+
+def series_name(make_value, model_value):
+    """ Key of a series in the saved ARIMA parameters """
+    return json.dumps([make_value, model_value])
+
+
+def read_params():
+    """ Read the saved ARIMA parameters.
+    Returns:
+    params (dict) -- series name -> params, and the data_version and as_of they were fit on
+    """
+    try:
+        with open(params_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saved_params(saved, make_value, model_value, data_version):
+    """ Saved ARIMA parameters of a series, and whether they were fit on exactly the data a fit
+    would use now (same data version and as-of month). Those are reused as they are, so the
+    forecasts don't drift from one restart to the next; otherwise they are only a warm start.
+    Arguments:
+    saved (dict) -- saved parameters, from read_params
+    make_value (str) -- make of the series
+    model_value (str) -- model of the series
+    data_version (str) -- version of the loaded data (tools.data_version)
+
+    Returns:
+    params (list) -- saved parameters, or None
+    current (bool) -- True if they can be reused without refitting
+    """
+    entry = saved.get(series_name(make_value, model_value), {})
+    current = (entry.get('data_version') == data_version) and (entry.get('as_of') == forecast_as_of())
+    return entry.get('params'), current and (entry.get('params') is not None)
+
+
+def save_params(fitted, data_version):
+    """ Save fitted ARIMA parameters, keeping those of the other series. Two processes saving at
+    once can drop each other's update, which only costs a cold start for those series.
+    Arguments:
+    fitted (dict) -- (make, model) -> fitted parameters
+    data_version (str) -- version of the data they were fit on (tools.data_version)
+    """
+    if len(fitted) == 0:
+        return
+    saved = read_params()
+    for (make_value, model_value), params in fitted.items():
+        saved[series_name(make_value, model_value)] = {'params' : params, 'data_version' : data_version, 'as_of' : forecast_as_of()}
+    try:
+        os.makedirs(tools.cache_path(), exist_ok=True)
+        tmp = params_path() + f".{os.getpid()}"
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, params_path())
+    except OSError:
+        pass # Read-only deployments just fit from scratch
+
+
+def fit_forecast(cube, ci, start_params=None, data_end=None, reuse=False):
+    """ Fit a forecast, returning None instead of raising if the series can't be fit.
+    Arguments:
+    cube (DataFrame) -- monthly cube, already filtered
+    ci (float) -- alpha of the confidence interval
+    start_params (list) -- saved parameters of the series to start from. If the fit fails
+                           from them, it is retried from scratch
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+    reuse (bool) -- forecast with start_params as they are, without refitting (see saved_params).
+                    If that fails, the series is fit as usual
+
+    Returns:
+    preds (DataFrame) -- arima predictions with confidence interval, or None
+    params (list) -- fitted parameters, or None
+    """
+    attempts = [(start_params, True), (None, True)] if start_params is not None else [(None, True)]
+    if reuse and (start_params is not None):
+        attempts.insert(0, (start_params, False))
+    for start, fit in attempts:
+        try:
+            with catch_warnings():
+                filterwarnings('ignore')
+                return chart_functions.arima_predictions(cube, ci=ci, start_params=start, return_params=True,
+                                                         data_end=data_end, fit=fit)
+        except Exception:
+            pass
+    return None, None
+
+
+def cached_arima_predictions(cube, make_value, model_value, data_version, ci=0.05, data_end=None):
+    """ arima_predictions served from the forecast store when possible. If the batch forecasts
+    have been run (batch_forecasts), series outside the top FORECAST_ARIMA_SERIES are served
+    from them instead, as are the top series ARIMA can't fit.
+    Arguments:
+    cube (DataFrame) -- monthly cube, already filtered on make/model
+    make_value (str) -- make dropdown value the data was filtered on
+    model_value (str) -- model dropdown value the data was filtered on
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+
+    Returns:
+    arima_preds (DataFrame) -- arima predictions with confidence interval.
+    """
+    if make_value is None:
+        model_value = None # The data isn't filtered on model without a make
+    key = forecast_key(make_value, model_value, data_version, ci)
+    batch = batch_store.get((data_version, ci, forecast_as_of()))
+    if (batch is not None) and ((make_value, model_value) in batch['forecasts']):
+        fallback = batch['forecasts'][(make_value, model_value)]
+        if (make_value, model_value) not in batch['arima']:
+            if fallback is None:
+                raise ValueError(f"Forecast not available for {make_value} : {model_value}")
+            return fallback.copy()
+    else:
+        fallback = None
+
+    preds = forecast_store.get(key, _MISSING)
+    if preds is _MISSING:
+        start_params, current = saved_params(read_params(), make_value, model_value, data_version)
+        with metrics.stage('model'):
+            preds, params = fit_forecast(cube, ci, start_params, data_end, reuse=current)
+        forecast_store.put(key, preds)
+        if (params is not None) and (params != start_params):
+            save_params({(make_value, model_value) : params}, data_version)
+
+    preds = fallback if preds is None else preds
+
+    if preds is None:
+        raise ValueError(f"Forecast not available for {make_value} : {model_value}")
+    return preds.copy()
+
+
+def forecast_series(monthly_cube, filter_index):
+    """ Every series the dropdowns can ask a forecast for: overall, each make, each make/model.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    filter_index (dict) -- filter index from tools.build_filter_index, including the monthly cube
+
+    Returns:
+    series (list) -- (make, model, monthly cube slice) tuples
+    """
+    index = filter_index['monthly_cube']
+    series = [(None, None, monthly_cube)]
+    for make in filter_index['purchases']['make']:
+        series.append((make, None, tools.filter_rows(monthly_cube, index, make)))
+    for (make, model) in filter_index['purchases']['make_model']:
+        series.append((make, model, tools.filter_rows(monthly_cube, index, make, model)))
+    return series
+
+
+def revenue_matrix(monthly_cube, filter_index, data_end=None):
+    """ Monthly revenue of every series the dropdowns can ask a forecast for (overall, each make,
+    each make/model) as one matrix, with a column for every month, including months without
+    sales. The columns end at the last complete month, the same window arima_predictions fits.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    filter_index (dict) -- filter index from tools.build_filter_index
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+
+    Returns:
+    series (list) -- (make, model) of each row, (None, None) for the overall series
+    revenue (array) -- series x months revenue
+    start (array) -- column of the first month with sales, per series (the number of months if none)
+    """
+    makes = list(filter_index['purchases']['make'])
+    make_models = list(filter_index['purchases']['make_model'])
+    series = [(None, None)] + [(make, None) for make in makes] + make_models
+
+    sales = monthly_cube[monthly_cube['purchase_count'] > 0]
+    if len(sales) == 0:
+        return series, np.zeros((len(series), 0)), np.zeros(len(series), dtype=np.int64)
+    month = (sales['year'] * 12 + sales['month'] - 1).to_numpy(dtype=np.int64)
+    end = chart_functions.last_complete_month(data_end)
+    last = end.year * 12 + end.month - 1
+    first = month.min()
+    keep = month <= last
+    n_months = max(last - first + 1, 0)
+
+    revenue = np.zeros((len(series), n_months))
+    cols = month[keep] - first
+    values = sales['revenue'].to_numpy(dtype=np.float64)[keep]
+    np.add.at(revenue, (np.zeros(len(cols), dtype=np.int64), cols), values)
+
+    # Cube rows -> make row and make/model row, -1 for makes/models without purchases
+    make_rows = {make : i + 1 for i, make in enumerate(makes)}
+    model_rows = {make_model : i + 1 + len(makes) for i, make_model in enumerate(make_models)}
+    row_make = sales['car_make'].astype(object).to_numpy()[keep]
+    row_model = sales['car_model'].astype(object).to_numpy()[keep]
+    for rows in [np.array([make_rows.get(make, -1) for make in row_make], dtype=np.int64),
+                 np.array([model_rows.get((make, model), -1) for make, model in zip(row_make, row_model)], dtype=np.int64)]:
+        found = rows >= 0
+        np.add.at(revenue, (rows[found], cols[found]), values[found])
+
+    nonzero = revenue != 0
+    start = np.where(nonzero.any(axis=1), nonzero.argmax(axis=1), n_months)
+    return series, revenue, start
+
+
+def smoothing_forecasts(revenue, start, steps=3, ci=0.05):
+    """ Holt's linear exponential smoothing of many series at once. Every (alpha, beta) in
+    SMOOTHING_ALPHAS x SMOOTHING_BETAS is run on every series side by side, and each series
+    keeps the pair with the smallest one step ahead squared error.
+    Arguments:
+    revenue (array) -- series x months, see revenue_matrix
+    start (array) -- column each series starts at, the months before it are ignored
+    steps (int) -- months to forecast
+    ci (float) -- alpha of the confidence interval
+
+    Returns:
+    mean, lower, upper (array) -- series x steps forecasts and interval bounds, floored at 0 (revenue
+                                  can't be negative), NaN for series with sales in fewer than
+                                  MIN_FORECAST_MONTHS months
+    """
+    alpha, beta = [grid.ravel()[None, :] for grid in np.meshgrid(SMOOTHING_ALPHAS, SMOOTHING_BETAS)]
+    n_series, n_months = revenue.shape
+    level = np.zeros((n_series, alpha.shape[1]))
+    trend = np.zeros_like(level)
+    sse = np.zeros_like(level)
+
+    for t in range(n_months):
+        y = revenue[:, t:t + 1]
+        first = (start == t)[:, None]
+        later = (start < t)[:, None]
+        predicted = level + trend
+        sse += np.where(later, (y - predicted) ** 2, 0)
+        new_level = alpha * y + (1 - alpha) * predicted
+        new_trend = beta * (new_level - level) + (1 - beta) * trend
+        level = np.where(first, y, np.where(later, new_level, level))
+        trend = np.where(later, new_trend, trend)
+
+    rows = np.arange(n_series)
+    best = sse.argmin(axis=1)
+    a, b = alpha[0, best][:, None], beta[0, best][:, None]
+    n_errors = np.maximum(n_months - start - 1, 1)[:, None]
+    sigma2 = sse[rows, best][:, None] / n_errors
+
+    h = np.arange(1, steps + 1)[None, :]
+    mean = level[rows, best][:, None] + h * trend[rows, best][:, None]
+    variance = sigma2 * (1 + (h - 1) * (a ** 2 + a * b * h + b ** 2 * h * (2 * h - 1) / 6))
+    z = NormalDist().inv_cdf(1 - ci / 2)
+    lower, upper = mean - z * np.sqrt(variance), mean + z * np.sqrt(variance)
+
+    # Months with sales, not months since the first sale: one old sale followed by zeros is no series
+    short = ((revenue != 0).sum(axis=1) < MIN_FORECAST_MONTHS)[:, None]
+    return [np.where(short, np.nan, np.maximum(x, 0)) for x in (mean, lower, upper)]
+
+
+def batch_forecasts(monthly_cube, filter_index, data_version, ci=0.05, data_end=None, arima_series=FORECAST_ARIMA_SERIES):
+    """ Forecast every series at once with smoothing_forecasts, and pick the series that
+    should be forecast with ARIMA. The result is kept in the batch store for
+    cached_arima_predictions, and only computed once per data version, ci and as-of month.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    filter_index (dict) -- filter index from tools.build_filter_index, including the monthly cube
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+    arima_series (int) -- number of series, by revenue, to leave to ARIMA
+
+    Returns:
+    batch (dict) -- 'forecasts': (make, model) -> predictions like arima_predictions (or None),
+                    'arima': the (make, model) series left to ARIMA
+    """
+    key = (data_version, ci, forecast_as_of())
+    batch = batch_store.get(key)
+    if batch is not None:
+        return batch
+
+    series, revenue, start = revenue_matrix(monthly_cube, filter_index, data_end)
+    mean, lower, upper = smoothing_forecasts(revenue, start, ci=ci)
+    forecasts = {}
+    for i, name in enumerate(series):
+        if np.isnan(mean[i, 0]):
+            forecasts[name] = None
+        else:
+            forecasts[name] = pd.DataFrame({'predicted_sales' : mean[i], 'prediction_lower_bound' : lower[i],
+                                            'prediction_upper_bound' : upper[i], 'month_delta' : range(len(mean[i]))})
+
+    by_revenue = np.argsort(-revenue.sum(axis=1), kind='stable')[:arima_series]
+    batch = {'forecasts' : forecasts, 'arima' : {series[i] for i in by_revenue}}
+    batch_store.put(key, batch)
+    return batch
+
+
+def _fit_series(make_value, model_value, cube, ci, start_params, reuse, data_end):
+    """ Process pool entry point for refit """
+    return (make_value, model_value) + fit_forecast(cube, ci, start_params, data_end, reuse)
+
+
+def refit(series, data_version, ci=0.10, workers=None, data_end=None):
+    """ Fit ARIMA forecasts in a process pool, each starting from the series' saved parameters,
+    and save the new parameters. Parameters saved for the same data are reused as they are (see saved_params).
+    Arguments:
+    series (list) -- (make, model, monthly cube slice) tuples, see forecast_series
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval
+    workers (int) -- number of worker processes, defaults to the cpu count
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+
+    Returns:
+    forecasts (dict) -- (make, model) -> arima predictions, or None if the series couldn't be fit
+    """
+    saved = read_params()
+    forecasts, fitted = {}, {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(_fit_series, make, model, data, ci, *saved_params(saved, make, model, data_version), data_end)
+                   for (make, model, data) in series]
+        for future in futures:
+            make, model, preds, params = future.result()
+            forecasts[(make, model)] = preds
+            if (params is not None) and (params != saved_params(saved, make, model, data_version)[0]):
+                fitted[(make, model)] = params
+    save_params(fitted, data_version)
+    return forecasts
+
+
+def warm_up(monthly_cube, filter_index, data_version, ci=0.10, workers=None, data_end=None):
+    """ Run the batch forecasts, then pre-fit the ARIMA series in a process pool and put them in the store.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    filter_index (dict) -- filter index from tools.build_filter_index, including the monthly cube
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval, matching what the charts ask for
+    workers (int) -- number of worker processes, defaults to the cpu count
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+
+    Returns:
+    fitted (int) -- number of series fit with ARIMA
+    """
+    batch = batch_forecasts(monthly_cube, filter_index, data_version, ci, data_end)
+    series = [s for s in forecast_series(monthly_cube, filter_index)
+              if ((s[0], s[1]) in batch['arima']) and (forecast_key(s[0], s[1], data_version, ci) not in forecast_store)]
+
+    forecasts = refit(series, data_version, ci, workers, data_end)
+    for (make, model), preds in forecasts.items():
+        forecast_store.put(forecast_key(make, model, data_version, ci), preds)
+    return len(forecasts)
+
+
+def start_warm_up(monthly_cube, filter_index, data_version, ci=0.10, data_end=None):
+    """ Start warm_up in a background thread if FORECAST_WARMUP is set, so the app can
+    start serving right away.
+    Arguments:
+    monthly_cube (DataFrame) -- monthly cube from tools.build_monthly_cube
+    filter_index (dict) -- filter index from tools.build_filter_index, including the monthly cube
+    data_version (str) -- version of the loaded data (tools.data_version)
+    ci (float) -- alpha of the confidence interval, matching what the charts ask for
+    data_end (Timestamp) -- date of the latest purchase in the data, see chart_functions.last_complete_month
+
+    Returns:
+    thread (Thread) -- the warm up thread, or None if warm up is turned off
+    """
+    if os.environ.get('FORECAST_WARMUP', '0').lower() in ('0', '', 'false', 'no'):
+        return None
+    if parent_process() is not None:
+        # Spawned pool workers re-import app.py, don't let them start their own pools
+        return None
+
+    workers = os.environ.get('FORECAST_WARMUP_WORKERS')
+    workers = int(workers) if workers else None
+    thread = threading.Thread(target=warm_up, args=(monthly_cube, filter_index, data_version, ci, workers, data_end),
+                              name='forecast-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refit the ARIMA forecasts of the dashboard's series and save their parameters, "
+                                                 "so the app's fits start from them.")
+    parser.add_argument('--all', action='store_true', help="refit every make and make/model series, not only the ARIMA series")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: cpu count)")
+    parser.add_argument('--ci', type=float, default=0.10, help="alpha of the confidence interval (default: 0.10)")
+    args = parser.parse_args()
+
+    version = tools.data_version()
+    purchases, opportunities, competitors, financials = tools.load_data()
+    monthly_cube = tools.load_monthly_cube(purchases, opportunities, version)
+    filter_index = tools.build_filter_index(purchases, opportunities, competitors, monthly_cube)
+    data_end = purchases['date_purchased'].max()
+    series = forecast_series(monthly_cube, filter_index)
+    if not args.all:
+        arima = batch_forecasts(monthly_cube, filter_index, version, args.ci, data_end)['arima']
+        series = [s for s in series if (s[0], s[1]) in arima]
+
+    start = time.perf_counter()
+    forecasts = refit(series, version, args.ci, args.workers, data_end)
+    failed = sum(preds is None for preds in forecasts.values())
+    print(f"Refit {len(forecasts)} series ({failed} could not be fit) in {time.perf_counter() - start:.1f}s, "
+          f"parameters saved to {params_path()}")
@@ -0,0 +1,153 @@
+import os
+import io
+import argparse
+import pandas as pd
+import data_cleaning
+import tools
+import quantile_sketch
+
+"""
+Incremental ingestion of new batches of purchase, opportunity or competitor data.
+
+A batch is a raw csv export in the same format as the files in the assets/raw_*_data
+directories. It is validated and cleaned the same way data_cleaning.py cleans the raw
+files, then appended to the stored csv, the dataset cache, the cached monthly cube and
+the cached competitor price sketches without reprocessing any of the rows already there.
+The data version changes with the append, so a running app picks up the new rows on its
+next request.
+
+Usage (from src):
+    python ingest.py purchases path/to/new_purchases.csv
+"""
+
+# Columns a raw batch must have, per dataset
+REQUIRED_COLUMNS = {'purchases' : ['opportunity_created', 'date_purchased', 'first_name', 'last_name', 'email', 'gender',
+                                   'financed', 'pct_financed', 'car_make', 'car_model', 'car_year', 'car_color', 'purchase_price'],
+                    'opportunities' : ['opportunity_created', 'first_name', 'last_name', 'email', 'gender', 'financing_reqd',
+                                       'pct_financed', 'car_make_interest', 'car_model_interest', 'car_year_interest',
+                                       'car_color_interest', 'purchase_price_range'],
+                    'competitors' : ['date_purchased', 'company', 'car_make', 'car_model', 'car_year', 'car_color', 'purchase_price']}
+
+DATE_COLUMNS = {'purchases' : ['opportunity_created', 'date_purchased'],
+                'opportunities' : ['opportunity_created'],
+                'competitors' : ['date_purchased']}
+
+NUMERIC_COLUMNS = {'purchases' : ['purchase_price', 'car_year'],
+                   'opportunities' : ['purchase_price_range'],
+                   'competitors' : ['purchase_price', 'car_year']}
+
+
+def read_batch(name, batch_file):
+    """ Read and validate a raw batch.
+    Arguments:
+    name (str) -- dataset name, one of REQUIRED_COLUMNS
+    batch_file (str) -- path to the raw csv batch
+
+    Returns:
+    batch (DataFrame) -- raw batch
+    """
+    if name not in REQUIRED_COLUMNS:
+        raise ValueError(f"Unknown dataset '{name}', expected one of {list(REQUIRED_COLUMNS)}")
+
+    batch = data_cleaning.read_raw_file(batch_file)
+    missing = [col for col in REQUIRED_COLUMNS[name] if col not in batch.columns]
+    if len(missing) > 0:
+        raise ValueError(f"Batch {batch_file} is missing columns: {', '.join(missing)}")
+
+    for col in DATE_COLUMNS[name]:
+        bad = pd.to_datetime(batch[col], errors='coerce').isna() & batch[col].notna()
+        if bad.any():
+            raise ValueError(f"Batch {batch_file} has {bad.sum()} unreadable dates in {col}")
+    for col in NUMERIC_COLUMNS[name]:
+        bad = pd.to_numeric(batch[col], errors='coerce').isna() & batch[col].notna()
+        if bad.any():
+            raise ValueError(f"Batch {batch_file} has {bad.sum()} non-numeric values in {col}")
+
+    return batch[REQUIRED_COLUMNS[name]]
+
+
+def next_index(source):
+    """ Index the next appended row should get, read from the last line of the stored csv.
+    Arguments:
+    source (str) -- path to the stored csv
+
+    Returns:
+    index (int)
+    """
+    with open(source, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 65536))
+        lines = f.read().decode().strip().splitlines()
+    last = lines[-1].split(',', 1)[0]
+    return int(last) + 1 if last.isdigit() else 0
+
+
+def ingest_batch(name, batch_file):
+    """ Validate, clean and append a raw batch to the stored dataset and its caches.
+    Arguments:
+    name (str) -- dataset name, one of REQUIRED_COLUMNS
+    batch_file (str) -- path to the raw csv batch
+
+    Returns:
+    batch (DataFrame) -- the batch as typed by tools.load_data
+    """
+    batch = data_cleaning.clean_raw(name, read_batch(name, batch_file))
+
+    source = tools.assets_path() + "/" + tools.DATASETS[name]
+    header = pd.read_csv(source, index_col=0, nrows=0).columns
+    start = next_index(source)
+    batch = batch.reindex(columns=header)
+    batch.index = pd.RangeIndex(start, start + len(batch))
+
+    # Note what the caches were built from before touching the csv
+    old_version = tools.data_version()
+    manifest = tools.read_manifest() if tools.arrow_available() else None
+    cache_fresh = (manifest is not None) and tools.cache_is_fresh(name, manifest)
+
+    # Append the rows to the csv, then type exactly those rows the way load_data would
+    csv_text = batch.to_csv()
+    with open(source, 'a') as f:
+        f.write(csv_text.split('\n', 1)[1])
+    typed = tools.clean_dataset(name, pd.read_csv(io.StringIO(csv_text), index_col=0))
+    new_version = tools.data_version()
+
+    if manifest is None:
+        return typed
+
+    if cache_fresh:
+        tools.append_cache(name, typed, manifest, tools.file_signature(source, with_hash=False))
+        tools.write_manifest(manifest)
+
+    # Fold the batch into the cached monthly cube (competitor rows don't touch it)
+    if manifest.get('monthly_cube') == old_version:
+        if name == 'competitors':
+            manifest['monthly_cube'] = new_version
+            tools.write_manifest(manifest)
+        else:
+            batch_cube = tools.build_monthly_cube(typed if name == 'purchases' else None,
+                                                  typed if name == 'opportunities' else None)
+            cube = tools.merge_cubes(pd.read_parquet(tools.cache_path() + "/monthly_cube.parquet"), batch_cube)
+            tools.write_cube_cache(cube, new_version)
+
+    # Fold the batch into the cached competitor price sketches (only competitor rows touch them)
+    manifest = tools.read_manifest()
+    if manifest.get('competitor_sketches') == old_version:
+        if name == 'competitors':
+            sketches = quantile_sketch.sketches_from_frame(tools.map_table(tools.cache_path() + "/competitor_sketches.arrow"))
+            quantile_sketch.update_sketches(sketches, typed)
+            quantile_sketch.write_sketch_cache(sketches, new_version)
+        else:
+            manifest['competitor_sketches'] = new_version
+            tools.write_manifest(manifest)
+
+    return typed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Append a raw batch of data to the dashboard's datasets.")
+    parser.add_argument('dataset', choices=list(REQUIRED_COLUMNS), help="dataset the batch belongs to")
+    parser.add_argument('batch_file', help="raw csv batch, in the same format as the assets/raw_*_data files")
+    args = parser.parse_args()
+
+    typed = ingest_batch(args.dataset, args.batch_file)
+    print(f"Appended {len(typed)} rows to {args.dataset} (data version {tools.data_version()})")
@@ -0,0 +1,169 @@
+import os
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+import tools
+
+"""
+Timing instrumentation for the callbacks, exposed in Prometheus text format on /metrics.
+
+Every instrumented callback records its total time, and the time spent in each stage of
+it: filter (narrowing the data to the make/model), aggregate (tables and KPIs), model
+(forecast fits), figure (building plotly figures) and serialize (figures to JSON, and
+Dash encoding the response). Stages can nest, e.g. a forecast fit is also part of the
+time of building the chart it is on. Figures are timed per chart as well.
+
+Timings are kept per process, so under gunicorn each worker reports its own.
+
+Set PROFILE_SLOW_SECONDS to dump cProfile stats of every callback slower than that many
+seconds to PROFILE_DIR (assets/.cache/profiles by default), to look at with pstats or snakeviz.
+"""
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+PROFILE_SLOW_SECONDS = os.environ.get('PROFILE_SLOW_SECONDS')
+PROFILE_SLOW_SECONDS = float(PROFILE_SLOW_SECONDS) if PROFILE_SLOW_SECONDS else None
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# (metric name, label pairs) -> [count per bucket (the last is +Inf)..., count, sum]
+_histograms = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+HELP = {'revops_callback_seconds' : 'Time spent in each Dash callback.',
+        'revops_stage_seconds' : 'Time spent in each stage of each Dash callback.',
+        'revops_chart_seconds' : 'Time spent building and serializing each chart.'}
+
+
+def observe(metric, labels, seconds):
+    """ Record a timing.
+    Arguments:
+    metric (str) -- metric name, one of HELP
+    labels (tuple) -- (label, value) pairs
+    seconds (float) -- time taken
+    """
+    key = (metric, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 3)
+        h[bisect_left(BUCKETS, seconds)] += 1 # Bucket counts are made cumulative when rendered
+        h[-2] += 1
+        h[-1] += seconds
+
+
+def current_callback():
+    """ Name of the callback running in this thread, if any """
+    return getattr(_local, 'callback', None)
+
+
+@contextmanager
+def stage(name, chart=None):
+    """ Time a stage of the running callback (and of a chart, if given).
+    Arguments:
+    name (str) -- stage name: filter, aggregate, model, figure or serialize
+    chart (str) -- chart the stage belongs to
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        callback = current_callback()
+        if callback is not None:
+            observe('revops_stage_seconds', (('callback', callback), ('stage', name)), seconds)
+        if chart is not None:
+            observe('revops_chart_seconds', (('chart', chart), ('stage', name)), seconds)
+
+
+def profile_path(name):
+    """ Path to dump a slow callback's profile to """
+    directory = PROFILE_DIR or tools.cache_path() + '/profiles'
+    os.makedirs(directory, exist_ok=True)
+    return f'{directory}/{name}-{time.strftime("%Y%m%dT%H%M%S")}-{time.perf_counter_ns() % 10**6:06d}.prof'
+
+
+def instrument(callback):
+    """ Decorator timing a Dash callback and the stages inside it, profiling it if
+    PROFILE_SLOW_SECONDS is set. Goes between @app.callback and the function.
+    Arguments:
+    callback (function) -- the callback
+
+    Returns:
+    wrapper (function)
+    """
+    name = callback.__name__
+
+    @wraps(callback)
+    def wrapper(*args):
+        outer = current_callback()
+        _local.callback = name
+        profiler = cProfile.Profile() if PROFILE_SLOW_SECONDS is not None else None
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                return callback(*args)
+            return profiler.runcall(callback, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            _local.callback = outer
+            _local.last = (name, seconds)
+            observe('revops_callback_seconds', (('callback', name),), seconds)
+            if profiler is not None and seconds >= PROFILE_SLOW_SECONDS:
+                try:
+                    profiler.dump_stats(profile_path(name))
+                except OSError:
+                    pass
+    return wrapper
+
+
+def request_started():
+    """ Flask before_request hook: note when a request started, to time its serialization """
+    _local.last = None
+    _local.request_start = time.perf_counter()
+
+
+def request_finished(response):
+    """ Flask after_request hook: time spent outside the callback (Dash encoding the response)
+    is recorded as the callback's serialize stage.
+    Arguments:
+    response (Response) -- flask response
+
+    Returns:
+    response (Response) -- unchanged
+    """
+    last = getattr(_local, 'last', None)
+    start = getattr(_local, 'request_start', None)
+    if last is not None and start is not None:
+        name, seconds = last
+        observe('revops_stage_seconds', (('callback', name), ('stage', 'serialize')),
+                max(time.perf_counter() - start - seconds, 0))
+    _local.last = None
+    return response
+
+
+def render():
+    """ All timings in Prometheus text format.
+    Returns:
+    text (str)
+    """
+    with _lock:
+        histograms = {key : list(h) for key, h in _histograms.items()}
+
+    lines = []
+    for metric, help_text in HELP.items():
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for (m, labels), h in sorted(histograms.items()):
+            if m != metric:
+                continue
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ['+Inf'], h[:-2]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_count{{{label_text}}} {h[-2]}')
+            lines.append(f'{metric}_sum{{{label_text}}} {h[-1]:.6f}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,261 @@
+import os
+import numpy as np
+import pandas as pd
+import tools
+
+"""
+Mergeable quantile sketches (KLL) of competitor prices per tier, make and model, so the
+benchmarking percentiles and competitor medians don't need a groupby over the whole
+competitor table on every render.
+
+A KLL sketch keeps a few hundred of the values it has seen, each standing in for a
+power-of-two number of the originals, and answers any quantile from them. With the
+default SKETCH_K=200, the value returned for a quantile q has a rank within about 1.65%
+of the group size of q (at 99% confidence), however many rows the group has; a larger
+k is more accurate and keeps proportionally more values. Groups of up to
+SKETCH_EXACT_ITEMS rows are kept whole, so their quantiles are exact (interpolated the
+way pandas does).
+
+Sketches are built once per data version and cached next to the monthly cube; batches of
+competitor rows appended with ingest.py are folded into them without touching the rows
+already summarized. Two sketches of the same group (e.g. from different scrapers or
+workers) can be merged with KLLSketch.merge.
+"""
+
+SKETCH_K = int(os.environ.get('SKETCH_K', 200))
+SKETCH_EXACT_ITEMS = int(os.environ.get('SKETCH_EXACT_ITEMS', 2048))
+
+# Competitor columns a sketch is kept for each value of
+SKETCH_DIMENSIONS = ['car_tier', 'car_make', 'car_model']
+
+# Competitor column the sketches summarize
+SKETCH_VALUE = 'purchase_price'
+
+
+class KLLSketch:
+    """ KLL quantile sketch. Level h holds values that each stand for 2**h of the values seen.
+    Arguments:
+    k (int) -- size of the top level, which sets the accuracy (see the module docstring)
+    exact_items (int) -- values kept whole, before the sketch starts compacting
+    seed (int) -- random seed of the compactions, fixed so the same data always gives the same sketch
+    """
+    def __init__(self, k=SKETCH_K, exact_items=SKETCH_EXACT_ITEMS, seed=0):
+        self.k = k
+        self.exact_items = exact_items
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+        self._sorted = None
+
+    @property
+    def n(self):
+        """ Number of values summarized """
+        return sum(len(level) << h for h, level in enumerate(self.levels))
+
+    @property
+    def exact(self):
+        """ True while every value seen is still kept """
+        return all(len(level) == 0 for level in self.levels[1:])
+
+    def capacity(self, h):
+        """ Most values level h can hold before it is compacted. Levels shrink by 2/3 going down """
+        return max(int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))), 2)
+
+    def update(self, values):
+        """ Add values to the sketch. Missing values are ignored.
+        Arguments:
+        values (array) -- values to add
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self.levels[0] = np.concatenate([self.levels[0], values[~np.isnan(values)]])
+        self._compress()
+
+    def merge(self, other):
+        """ Add everything another sketch has summarized to this one.
+        Arguments:
+        other (KLLSketch) -- sketch to merge in, left unchanged
+        """
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self._compress()
+
+    def _compress(self):
+        """ Compact levels over their capacity until none is """
+        self._sorted = None
+        if self.exact and len(self.levels[0]) <= self.exact_items:
+            return
+
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) <= self.capacity(h):
+                h += 1
+                continue
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+
+            # Sort the level and promote every other value (starting at random) a level up, with twice
+            # the weight. An odd value out stays behind, so the total weight is unchanged
+            level = self.levels[h]
+            leftover, level = level[len(level) - len(level) % 2:], np.sort(level[:len(level) - len(level) % 2])
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[self._rng.integers(2)::2]])
+            self.levels[h] = leftover
+            h = 0 # Adding a level shrinks the capacity of the ones below it
+
+    def _cdf(self):
+        """ Kept values, sorted, with the cumulative weight up to and including each """
+        if self._sorted is None:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(level), 1 << h) for h, level in enumerate(self.levels)])
+            order = np.argsort(values, kind='stable')
+            self._sorted = (values[order], np.cumsum(weights[order]))
+        return self._sorted
+
+    def quantile(self, q):
+        """ Estimated quantiles of the values summarized.
+        Arguments:
+        q (float or list) -- quantile(s), between 0 and 1
+
+        Returns:
+        quantiles (float or array) -- NaN if the sketch is empty
+        """
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        if self.exact:
+            return np.quantile(self.levels[0], q)
+
+        values, cumulative = self._cdf()
+        ranks = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1], side='left')
+        return values[np.minimum(ranks, len(values) - 1)]
+
+
+def build_sketches(competitors):
+    """ Sketch the competitor prices of every tier, make and model.
+    Arguments:
+    competitors (DataFrame) -- competitor data from tools.load_data
+
+    Returns:
+    sketches (dict) -- dimension (SKETCH_DIMENSIONS) -> value -> KLLSketch
+    """
+    sketches = {dimension : {} for dimension in SKETCH_DIMENSIONS}
+    update_sketches(sketches, competitors)
+    return sketches
+
+
+def update_sketches(sketches, batch):
+    """ Fold new competitor rows into the sketches.
+    Arguments:
+    sketches (dict) -- sketches from build_sketches, updated in place
+    batch (DataFrame) -- new competitor rows, typed as tools.load_data types them
+    """
+    for dimension in SKETCH_DIMENSIONS:
+        for key, values in batch.groupby(dimension, observed=True)[SKETCH_VALUE]:
+            if key not in sketches[dimension]:
+                sketches[dimension][key] = KLLSketch()
+            sketches[dimension][key].update(values.to_numpy())
+
+
+def sketch_quantiles(sketches, dimension, q):
+    """ Competitor price quantiles of every value of a dimension, like
+    groupby(dimension)['purchase_price'].quantile(q) but from the sketches.
+    Arguments:
+    sketches (dict) -- sketches from build_sketches
+    dimension (str) -- one of SKETCH_DIMENSIONS
+    q (list) -- quantiles, between 0 and 1
+
+    Returns:
+    quantiles (DataFrame) -- one column per quantile (named str(q)), indexed by the dimension's values (sorted)
+    """
+    keys = sorted(key for key, sketch in sketches[dimension].items() if sketch.n > 0)
+    quantiles = pd.DataFrame([sketches[dimension][key].quantile(q) for key in keys],
+                             index=pd.Index(keys, name=dimension), columns=[str(x) for x in q])
+    return quantiles
+
+
+def sketch_medians(sketches, dimension):
+    """ Competitor median price of every value of a dimension, from the sketches.
+    Arguments:
+    sketches (dict) -- sketches from build_sketches
+    dimension (str) -- one of SKETCH_DIMENSIONS
+
+    Returns:
+    medians (Series) -- indexed by the dimension's values (sorted)
+    """
+    return sketch_quantiles(sketches, dimension, [0.5])['0.5'].rename(SKETCH_VALUE)
+
+
+def sketches_frame(sketches):
+    """ Flatten the sketches into a table, to cache them.
+    Arguments:
+    sketches (dict) -- sketches from build_sketches
+
+    Returns:
+    frame (DataFrame) -- dimension, key, level and value of every value kept
+    """
+    parts = [pd.DataFrame({'dimension' : dimension, 'key' : str(key), 'level' : h, 'value' : level})
+             for dimension in SKETCH_DIMENSIONS for key, sketch in sketches[dimension].items()
+             for h, level in enumerate(sketch.levels) if len(level) > 0]
+    if len(parts) == 0:
+        return pd.DataFrame({'dimension' : [], 'key' : [], 'level' : [], 'value' : []})
+    return pd.concat(parts, ignore_index=True)
+
+
+def sketches_from_frame(frame):
+    """ Rebuild the sketches from the table sketches_frame made.
+    Arguments:
+    frame (DataFrame) -- cached sketches
+
+    Returns:
+    sketches (dict) -- dimension -> value -> KLLSketch
+    """
+    sketches = {dimension : {} for dimension in SKETCH_DIMENSIONS}
+    for (dimension, key), rows in frame.groupby(['dimension', 'key'], sort=False):
+        sketch = KLLSketch(seed=len(rows))
+        for h, level in rows.groupby('level')['value']:
+            while len(sketch.levels) <= h:
+                sketch.levels.append(np.empty(0))
+            sketch.levels[h] = level.to_numpy(dtype=np.float64)
+        sketches[dimension][key] = sketch
+    return sketches
+
+
+def load_sketches(competitors, version, use_cache=True):
+    """ Load the competitor sketches from the cache if they were built for this version of the
+    data, otherwise build them (and cache them).
+    Arguments:
+    competitors (DataFrame) -- competitor data from tools.load_data
+    version (str) -- version of the loaded data (tools.data_version)
+    use_cache (bool) -- read from/write to the cache if possible
+
+    Returns:
+    sketches (dict) -- see build_sketches
+    """
+    use_cache = use_cache and tools.arrow_available()
+    if use_cache:
+        manifest = tools.read_manifest()
+        if manifest.get('competitor_sketches') == version:
+            try:
+                return sketches_from_frame(tools.map_table(tools.cache_path() + "/competitor_sketches.arrow"))
+            except Exception:
+                pass
+
+    sketches = build_sketches(competitors)
+    if use_cache:
+        try:
+            write_sketch_cache(sketches, version)
+        except OSError:
+            pass
+    return sketches
+
+
+def write_sketch_cache(sketches, version):
+    """ Save the competitor sketches to the cache.
+    Arguments:
+    sketches (dict) -- sketches from build_sketches
+    version (str) -- version of the data the sketches summarize (tools.data_version)
+    """
+    os.makedirs(tools.cache_path(), exist_ok=True)
+    tools.write_table(sketches_frame(sketches), tools.cache_path() + "/competitor_sketches.arrow")
+    manifest = tools.read_manifest()
+    manifest['competitor_sketches'] = version
+    tools.write_manifest(manifest)
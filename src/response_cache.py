@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import date
+from functools import wraps
+import plotly
+import tools
+
+"""
+Server-side cache of whole callback responses (the charts and tables a tab returns),
+keyed by the callback, its inputs, the data version and the day. Most requests are for
+the same few make/model filters, so rendering each one once per data version saves
+rebuilding every figure on every request.
+
+Responses are stored as JSON in a SQLite database, so gunicorn workers on the same
+machine share one cache. Entries expire after RESPONSE_CACHE_TTL seconds, and the least
+recently used are evicted past RESPONSE_CACHE_SIZE entries. Set RESPONSE_CACHE=1 to turn
+the cache on (or to the path of the database, to put it somewhere other than the
+assets cache directory).
+"""
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+
+
+class ResponseCache:
+    """ SQLite backed key/value store with LRU and TTL eviction, safe to share between
+    threads and processes.
+    Arguments:
+    db_path (str) -- path of the SQLite database, created if it doesn't exist
+    maxsize (int) -- number of entries kept before the least recently used are evicted
+    ttl (float) -- seconds an entry is served for after it was stored
+    """
+    def __init__(self, db_path, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                         '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+
+    def _connection(self):
+        """ One connection per thread (sqlite connections can't be shared between threads) """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        conn = self._connection()
+        row = conn.execute('SELECT value FROM responses WHERE key = ? AND created >= ?',
+                           (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return default
+        conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, value, now, now))
+        conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        conn.execute('DELETE FROM responses WHERE key NOT IN '
+                     '(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)', (self.maxsize,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def clear(self):
+        self._connection().execute('DELETE FROM responses')
+
+
+def open_cache():
+    """ Open the response cache configured by RESPONSE_CACHE.
+    Returns:
+    cache (ResponseCache) -- the cache, or None if it is turned off
+    """
+    setting = os.environ.get('RESPONSE_CACHE', '0')
+    if setting.lower() in ('0', '', 'false', 'no'):
+        return None
+    db_path = tools.cache_path() + '/responses.sqlite' if setting.lower() in ('1', 'true', 'yes') else setting
+    return ResponseCache(db_path)
+
+
+response_store = open_cache()
+
+
+def response_key(name, args, data_version):
+    """ Key of a callback response in the store.
+    Arguments:
+    name (str) -- callback name
+    args (tuple) -- callback inputs
+    data_version (str) -- version of the loaded data (tools.data_version)
+
+    Returns:
+    key (str)
+    """
+    # Charts are relative to today (trailing twelve months etc.), so responses only last the day
+    return json.dumps([name, list(args), data_version, date.today().isoformat()])
+
+
+def cached_response(current_version):
+    """ Decorator serving a Dash callback's responses from the response store.
+    Goes between @app.callback and the function. Does nothing if the cache is off.
+    Arguments:
+    current_version (function) -- returns the version of the loaded data, refreshing it first if needed
+
+    Returns:
+    decorator (function)
+    """
+    def decorator(callback):
+        if response_store is None:
+            return callback
+
+        @wraps(callback)
+        def wrapper(*args):
+            try:
+                key = response_key(callback.__name__, args, current_version())
+                hit = response_store.get(key)
+            except sqlite3.Error:
+                return callback(*args)
+            if hit is not None:
+                return json.loads(hit)
+
+            response = callback(*args)
+            try:
+                response_store.put(key, json.dumps(response, cls=plotly.utils.PlotlyJSONEncoder))
+            except sqlite3.Error:
+                pass # A busy or unwritable cache shouldn't fail the request
+            return response
+        return wrapper
+    return decorator
@@ -3,22 +3,22 @@ import plotly.express as px
 import plotly.graph_objects as go
 from dateutil.relativedelta import relativedelta
 from datetime import date
+import chart_functions
 
-def ttm_sales_cycle_days(data_p):
+def ttm_sales_cycle_days(cube):
     """ Chart the sales cycle days, trailing twelve months
     Arguments:
-    data_p (DataFrame) -- purchase data previously loaded in from csv
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, filtered on make/model
 
     Returns:
     chart figure
     """
-    ttm_data = data_p.copy()
-    ttm_data['time_delta'] = ttm_data['date_purchased'] - ttm_data['opportunity_created']
-    ttm_data['time_delta'] = ttm_data['time_delta'].apply(lambda x: x.days)
-    
-    ttm_sales = ttm_data.groupby(['year', 'month'])['time_delta'].mean().reset_index()
-    ttm_sales = ttm_sales.tail(12)
-    ttm_sales['label'] = ttm_sales['year'].apply(lambda x: str(x)) + '_' + ttm_sales['month'].apply(lambda x: str(x))
+    # Last 12 months with sales data. Months without sales have no cycle days to average, and
+    # left in as gaps they would break the line into isolated points that plotly doesn't draw
+    ttm_sales = chart_functions.monthly_calendar(cube, 'purchase_count')
+    ttm_sales = ttm_sales[ttm_sales['purchase_count'] > 0].tail(12)
+    ttm_sales['time_delta'] = ttm_sales['sales_cycle_days'] / ttm_sales['sales_cycle_count']
+    ttm_sales['label'] = ttm_sales.index.strftime('%Y_') + ttm_sales.index.month.astype(str)
     
     fig_ttm_cycle = go.Figure()
     fig_ttm_cycle.add_trace(go.Scatter(x=ttm_sales['label'], y=ttm_sales['time_delta'], 
@@ -30,7 +30,8 @@ def ttm_sales_cycle_days(data_p):
 
 
 def ttm_sales_cycle_strip(make_value, data_p):
-    """ Chart the sales cycle days, trailing twelve months, distribution breakdown by make/model
+    """ Chart the sales cycle days, trailing twelve months, distribution breakdown by make/model.
+    Above chart_functions.AGGREGATE_ROWS rows, a sample of up to STRIP_SAMPLE_SIZE points per make/model is shown.
     Arguments:
     make_value (str) -- dropdown value of car make
     data_p (DataFrame) -- purchase data previously loaded in from csv
@@ -38,49 +39,47 @@ def ttm_sales_cycle_strip(make_value, data_p):
     Returns:
     chart figure
     """
-    ttm_data = data_p.copy()
-    ttm_data['time_delta'] = ttm_data['date_purchased'] - ttm_data['opportunity_created']
-    ttm_data['time_delta'] = ttm_data['time_delta'].apply(lambda x: x.days)
+    # Only the TTM rows, and only the columns the chart needs, are pulled out of the data
+    ttm = (data_p['date_purchased'] <= pd.to_datetime(date.today())) & (data_p['date_purchased'] >= pd.to_datetime(date.today() + relativedelta(months=-13)))
+    col = 'car_make' if make_value == None else 'car_model'
+    ttm_sales = pd.DataFrame({col : data_p[col][ttm],
+                              'time_delta' : data_p['sales_cycle_days'][ttm]})
+
+    if len(ttm_sales) > chart_functions.AGGREGATE_ROWS:
+        # Too many points for the browser, send a sample of each make/model
+        ttm_sales = chart_functions.stratified_sample(ttm_sales, col, chart_functions.STRIP_SAMPLE_SIZE)
+    fig_strip_sales = px.strip(ttm_sales, x='time_delta', y=col, color_discrete_sequence=["#4287F5"])
 
     if make_value == None:
-        ttm_sales = ttm_data[(ttm_data['date_purchased'] <= pd.to_datetime(date.today())) & (ttm_data['date_purchased'] >= pd.to_datetime(date.today() + relativedelta(months=-13)))]
-        fig_strip_sales = px.strip(ttm_sales, x='time_delta', y='car_make', color_discrete_sequence=["#4287F5"])
         fig_strip_sales.update_layout(title_text='TTM Sales Cycle by Make', title_x = 0.5, 
                           xaxis_title='TTM Sales Cycle Days', yaxis_title='Car Make')
     else:
-        ttm_sales = ttm_data[(ttm_data['date_purchased'] <= pd.to_datetime(date.today())) & (ttm_data['date_purchased'] >= pd.to_datetime(date.today() + relativedelta(months=-13)))]
-        fig_strip_sales = px.strip(ttm_sales, x='time_delta', y='car_model', color_discrete_sequence=["#4287F5"])
         fig_strip_sales.update_layout(title_text='TTM Sales Cycle by Model', title_x = 0.5, 
                           xaxis_title='TTM Sales Cycle Days', yaxis_title='Car Model')
-        
+
     return fig_strip_sales
 
 
-def ttm_win_rate(data_p, data_o):
+def ttm_win_rate(cube):
     """ Chart the win rate, month-by-month
     Arguments:
-    data_p (DataFrame) -- purchase data previously loaded in from csv
-    data_o (DataFrame) -- opportunity data previously loaded in from csv
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, filtered on make/model
 
     Returns:
     chart figure
     """
-    ttm_data_p = data_p.copy()
-    ttm_data_o = data_o.copy()
-
-    # Get total counts for each month
-    ttm_purch = ttm_data_p.groupby(['year','month'])['date_purchased'].count().reset_index()
-    ttm_opps = ttm_data_o.groupby(['year','month'])['opportunity_created'].count().reset_index()
+    # Get total counts for each month, on a complete calendar so the rolling windows are calendar months
+    ttm_purch = chart_functions.monthly_calendar(cube, 'purchase_count')['purchase_count']
+    ttm_opps = chart_functions.monthly_calendar(cube, 'opportunity_count')['opportunity_count']
 
     # Get rolling sum for each month - purchases=6m, opportunities=12m
-    ttm_purch['rolling_purchases'] = ttm_purch['date_purchased'].rolling(6).sum()
-    ttm_opps['rolling_opportunities'] = ttm_opps['opportunity_created'].rolling(12).sum()
+    ttm_winrt = pd.concat([ttm_purch.rolling(6).sum().rename('rolling_purchases'),
+                           ttm_opps.rolling(12).sum().rename('rolling_opportunities')], axis=1).sort_index()
 
     # Get win rates
-    ttm_winrt = pd.merge(ttm_purch, ttm_opps, how='outer', on=['year','month']).sort_values(by=['year','month'])
     ttm_winrt['win_rt'] = ttm_winrt['rolling_purchases'] / (ttm_winrt['rolling_purchases'] + ttm_winrt['rolling_opportunities']) * 100
     ttm_winrt = ttm_winrt.tail(12)
-    ttm_winrt['label'] = ttm_winrt['year'].apply(lambda x: str(x)) + '_' + ttm_winrt['month'].apply(lambda x: str(x))
+    ttm_winrt['label'] = ttm_winrt.index.strftime('%Y_') + ttm_winrt.index.month.astype(str)
 
     fig_ttm_winrt = px.line(ttm_winrt, x='label', y='win_rt')
     fig_ttm_winrt.update_layout(title_text='TTM Win Rate', title_x = 0.5, 
@@ -95,11 +94,11 @@ def ttm_win_rate(data_p, data_o):
     return fig_ttm_winrt
 
 
-def customer_acq_cost(data_p, financials):
+def customer_acq_cost(cube, financials):
     """ Chart the customer acquisition cost by quarter
     Arguments:
-    make_value (str) -- dropdown value of car make
-    data_p (DataFrame) -- purchase data previously loaded in from csv
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, filtered on make/model
+    financials (DataFrame) -- financial data previously loaded in from csv
 
     Returns:
     chart figure
@@ -109,7 +108,8 @@ def customer_acq_cost(data_p, financials):
             7 : "_q3", 8 : "_q3", 9 : "_q3",
             10 : "_q4", 11 : "_q4", 12 : "_q4"}
 
-    new_customer_count = data_p.groupby(['year', 'month'])['date_purchased'].count().reset_index()
+    new_customer_count = chart_functions.monthly_totals(cube, 'purchase_count')[['year', 'month', 'purchase_count']]
+    new_customer_count = new_customer_count.rename(columns={'purchase_count' : 'date_purchased'})
     new_customer_count['quarter'] = new_customer_count['year'].apply(lambda x: str(x)) + new_customer_count['month'].apply(lambda x: mth_q_dict[x])
     new_customer_count = new_customer_count.groupby('quarter')['date_purchased'].sum()
 
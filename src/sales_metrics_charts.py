@@ -1,54 +1,28 @@
 import pandas as pd
-import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from dateutil.relativedelta import relativedelta
 from datetime import date
 import chart_functions
+import forecasting
 
-def yoy_sales_chart(data):
+def yoy_sales_chart(cube, make_value=None, model_value=None, data_version=None, data_end=None):
     """ Year over year sales, trailing twelve months, + 3m forecast
     Arguments:
-    data (DataFrame) -- purchase previously data loaded in from csv
+    cube (DataFrame) -- monthly cube from tools.build_monthly_cube, filtered on make/model
+    make_value (str) -- dropdown make value the data is filtered on
+    model_value (str) -- dropdown model value the data is filtered on
+    data_version (str) -- version of the loaded data; if given, forecasts are served from the forecast store
+    data_end (Timestamp) -- date of the latest purchase in the data, the forecast is fit up to the last complete month
 
     Returns:
     chart figure
     """
-    # Initialize dates
-    last_mth = pd.to_datetime(date.today() + relativedelta(months=-1, day=31)) # Get last day of previous month
-    lookback = pd.to_datetime(date.today() + relativedelta(months=-13, day=31))
-    prev_lookback_start = pd.to_datetime(date.today() + relativedelta(months=-13, day=31))
-    prev_lookback_end =  pd.to_datetime(date.today() + relativedelta(months=-25, day=31))
-
-    ttm = data[(data['date_purchased'] <= last_mth) & ((data['date_purchased'] > lookback))]
-    prev_ttm = data[(data['date_purchased'] <= prev_lookback_start) & ((data['date_purchased'] > prev_lookback_end))]
-
-    _1yr = ttm.groupby('month')['purchase_price'].sum()
-    _2yr = prev_ttm.groupby('month')['purchase_price'].sum()
-
-    # In filtering cases where the month has no sales, add 0 for that month
-    months = list(range(1,13))
-    _1yr_mths_needed = [x for x in months if x not in _1yr.index]
-    _2yr_mths_needed = [x for x in months if x not in _2yr.index]
-
-    if len(_1yr_mths_needed) > 0:
-        _1yr_zeros = np.zeros(len(_1yr_mths_needed))
-        _1yr_add = pd.Series(data=_1yr_zeros, index=_1yr_mths_needed)
-        _1yr = pd.concat([_1yr, _1yr_add]).sort_index()
-    
-    if len(_2yr_mths_needed) > 0:
-        _2yr_zeros = np.zeros(len(_2yr_mths_needed))
-        _2yr_add = pd.Series(data=_2yr_zeros, index=_2yr_mths_needed)
-        _2yr = pd.concat([_2yr, _2yr_add]).sort_index()
-
-    # Set names for columns/legend later
-    _1yr.name = 'ttm'
-    _2yr.name = 'prev_ttm'
-
-    # Get the months in the right order
-    last_mth_idx = (date.today() + relativedelta(months=-1)).month
-    _1yr = pd.concat([_1yr[last_mth_idx:], _1yr[:last_mth_idx]])
-    _2yr = pd.concat([_2yr[last_mth_idx:], _2yr[:last_mth_idx]])
+    # Sales of the last 24 full months, on a complete calendar (months without sales are 0)
+    this_mth = pd.Period(date.today(), 'M')
+    sales = chart_functions.monthly_calendar(cube, 'purchase_count', start=this_mth - 24, end=this_mth - 1)['revenue']
+
+    _1yr = sales.loc[this_mth - 12:this_mth - 1].rename('ttm') # Last 12 full months
+    _2yr = sales.loc[this_mth - 24:this_mth - 13].rename('prev_ttm') # The 12 months before that
 
     _1yr.index = list(range(-12,0,1))
     _2yr.index = list(range(-12,0,1))
@@ -63,7 +37,10 @@ def yoy_sales_chart(data):
     fig_yoy.add_trace(go.Scatter(x=ttm_all['month_delta'], y=ttm_all['prev_ttm'], name="Previous TTM",  fill=None, opacity=.6, line=dict(color='#4285F4', dash='dot', width=4)))
     try:
         # Add predictions (lb, mean, ub), if possible
-        arima_predictions = chart_functions.arima_predictions(data, ci=0.10)
+        if data_version is None:
+            arima_predictions = chart_functions.arima_predictions(cube, ci=0.10, data_end=data_end)
+        else:
+            arima_predictions = forecasting.cached_arima_predictions(cube, make_value, model_value, data_version, ci=0.10, data_end=data_end)
         # Add a row with most recent data so that the charts connect, converging at point
         last_mth_row = pd.DataFrame({'month_delta' : -1, 'predicted_sales' : ttm_all['ttm'].tail(1), 
                                     'prediction_lower_bound' : ttm_all['ttm'].tail(1),
@@ -142,8 +119,15 @@ def sunburst_chart(data, pth):
     Returns:
     chart figure
     """
-    fig_sburst = px.sunburst(data, 
-                    path=pth, 
+    # Sum up front so plotly only sees make/model combinations that actually exist
+    # (categorical columns would otherwise expand to every category)
+    sburst_data = data.groupby(pth, observed=True)['purchase_price'].sum().sort_index().reset_index()
+    for col in pth:
+        if sburst_data[col].dtype.name == 'category':
+            sburst_data[col] = sburst_data[col].astype(object)
+
+    fig_sburst = px.sunburst(sburst_data,
+                    path=pth,
                     values='purchase_price', 
                     color_continuous_scale=['#FFFFFF', '#4285F4', '#224680'], # Not working...?
                     )
@@ -163,14 +147,14 @@ def sales_metrics_tables(make_value, data):
     chart figure
     """
     if make_value == None:
-        top_5_sales = data.groupby('car_make')['purchase_price'].sum().sort_values(ascending=False).head(10).apply(lambda x: f"${x/1000:,.0f}k")\
+        top_5_sales = data.groupby('car_make', observed=True)['purchase_price'].sum().sort_index().sort_values(ascending=False).head(10).apply(lambda x: f"${x/1000:,.0f}k")\
                         .reset_index().rename(columns={'car_make' : 'Car Make', 'purchase_price' : 'Top 10 Total Sales'})
-        top_5_count = data.groupby('car_make')['purchase_price'].count().sort_values(ascending=False).head(10)\
+        top_5_count = data.groupby('car_make', observed=True)['purchase_price'].count().sort_index().sort_values(ascending=False).head(10)\
                         .reset_index().rename(columns={'car_make' : 'Car Make', 'purchase_price' : 'Top 10 Total Count'})
     else:
-        top_5_sales = data.groupby('car_model')['purchase_price'].sum().sort_values(ascending=False).head(10).apply(lambda x: f"${x/1000:,.0f}k")\
+        top_5_sales = data.groupby('car_model', observed=True)['purchase_price'].sum().sort_index().sort_values(ascending=False).head(10).apply(lambda x: f"${x/1000:,.0f}k")\
                         .reset_index().rename(columns={'car_model' : 'Car Model', 'purchase_price' : 'Top 10 Total Sales'})
-        top_5_count = data.groupby('car_model')['purchase_price'].count().sort_values(ascending=False).head(10)\
+        top_5_count = data.groupby('car_model', observed=True)['purchase_price'].count().sort_index().sort_values(ascending=False).head(10)\
                         .reset_index().rename(columns={'car_model' : 'Car Model', 'purchase_price' : 'Top 10 Total Count'})
 
     return top_5_sales, top_5_count
\ No newline at end of file
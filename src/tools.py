@@ -1,39 +1,717 @@
 import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 from dateutil.relativedelta import relativedelta
 
-def load_data():
-    """ Load the data into the code from csv files.
+"""
+Data loading helpers for the app.
+
+Parsing the csv files (and especially inferring the date formats) is the slowest
+part of starting up the app, so once the data has been cleaned and typed it is
+saved to a columnar cache in `assets/.cache`. The cache is only rebuilt when one of
+the source csv files changes, and the csv files are used directly whenever the cache
+is missing or pyarrow is not installed. Batches appended with ingest.py are cached as
+extra parts, so the rows already in the cache never have to be re-parsed.
+
+The datasets are cached as uncompressed Arrow files, which are memory mapped rather
+than read: the numeric, date and categorical columns point straight into the file, so
+opening the cache costs next to nothing and only the pages a chart actually touches
+are ever read from disk. Only the text columns are decoded up front, and the compact
+schema skips the PII columns without reading them at all.
+
+With several gunicorn workers, SHARED_DATA=1 has the first worker publish the loaded
+datasets as uncompressed Arrow files in `assets/.cache/shared`, which every worker
+(including the first) memory maps. The numeric, date and categorical columns are then
+backed by the same pages of the page cache in every worker instead of a copy each, and
+the workers after the first only have to map the files to start.
+"""
+
+# Bump this whenever the cleaning below (or the cache format) changes so that old caches are rebuilt
+CACHE_SCHEMA = 3
+
+# Dataset name -> source csv file in the assets directory
+DATASETS = {'purchases' : 'purchases.csv',
+            'opportunities' : 'opportunities.csv',
+            'competitors' : 'competitor_data.csv',
+            'financials' : 'financials.csv'}
+
+# Set COMPACT_DATA=1 to load the datasets with the compact schema (see compact_dataset)
+COMPACT_DATA = os.environ.get('COMPACT_DATA', '0').lower() not in ('0', '', 'false', 'no')
+
+# Set SHARED_DATA=1 to share one copy of the datasets between worker processes (see load_shared)
+SHARED_DATA = os.environ.get('SHARED_DATA', '0').lower() not in ('0', '', 'false', 'no')
+
+# Personal details the dashboard never reads, dropped by the compact schema
+PII_COLUMNS = ['first_name', 'last_name', 'email', 'gender']
+
+# Compact schema: column -> smallest dtype that holds it
+COMPACT_DTYPES = {'month' : 'int8', 'year' : 'int16', 'car_year' : 'int16', 'car_year_interest' : 'int16',
+                  'purchase_price' : 'int32', 'purchase_price_range' : 'int32', 'pct_financed' : 'float32',
+                  'sales_cycle_days' : 'int16'}
+
+# Low cardinality text columns that are stored as categoricals
+CATEGORICAL_COLUMNS = {'purchases' : ['car_make', 'car_model', 'car_tier'],
+                       'opportunities' : ['car_make_interest', 'car_model_interest'],
+                       'competitors' : ['car_make', 'car_model', 'car_tier'],
+                       'financials' : []}
+
+
+def assets_path():
+    """ Path of the assets directory, relative to the working directory (src).
+    Returns:
+    path (str) -- path to the assets directory
+    """
+    return os.path.dirname(os.getcwd()) + "/assets" # Go up one directory
+
+
+def cache_path():
+    """ Path of the cache directory.
+    Returns:
+    path (str) -- path to the cache directory
+    """
+    return assets_path() + "/.cache"
+
+
+def arrow_available():
+    """ Check whether pyarrow is installed. The caches are written with it: Arrow IPC files for the
+    datasets and sketches, parquet for the small monthly cube.
+    Returns:
+    available (bool) -- True if pyarrow can be imported
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def file_signature(file_path, with_hash=True):
+    """ Signature of a source file used to decide when the cache is stale.
+    Arguments:
+    file_path (str) -- path to the file
+    with_hash (bool) -- also compute the sha1 of the file contents
+
+    Returns:
+    signature (dict) -- mtime, size and (optionally) sha1 of the file
+    """
+    stat = os.stat(file_path)
+    signature = {'mtime' : stat.st_mtime, 'size' : stat.st_size}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        signature['sha1'] = sha1.hexdigest()
+    return signature
+
+
+def data_version():
+    """ Version tag of the source data on disk. It changes whenever any source csv is
+    rewritten, so it can be used in cache keys to drop results built from older data.
+    Returns:
+    version (str) -- short hash of the source file signatures
+    """
+    signatures = {name : file_signature(assets_path() + "/" + file, with_hash=False) for name, file in DATASETS.items()}
+    return hashlib.sha1(json.dumps(signatures, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def clean_dataset(name, df):
+    """ Type a raw dataset as read from csv and add the derived columns.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    df (DataFrame) -- dataset as read from csv
+
+    Returns:
+    df (DataFrame) -- typed dataset
+    """
+    if name == 'purchases':
+        df['opportunity_created'] = pd.to_datetime(df['opportunity_created'])
+        df['date_purchased'] = pd.to_datetime(df['date_purchased'])
+        df['pct_financed'] = np.where(df['financed'] == False, 0, df['pct_financed']) # Formatting data where Mockaroo would not cooperate
+        df['sales_cycle_days'] = (df['date_purchased'] - df['opportunity_created']).dt.days
+        df['month'] = df['date_purchased'].dt.month
+        df['year'] = df['date_purchased'].dt.year
+
+    elif name == 'opportunities':
+        df['opportunity_created'] = pd.to_datetime(df['opportunity_created'])
+        df['month'] = df['opportunity_created'].dt.month
+        df['year'] = df['opportunity_created'].dt.year
+
+    elif name == 'competitors':
+        df['date_purchased'] = pd.to_datetime(df['date_purchased'])
+        df['month'] = df['date_purchased'].dt.month
+
+    for col in CATEGORICAL_COLUMNS[name]:
+        df[col] = df[col].astype('category')
+
+    return df
+
+
+def compact_dataset(name, df):
+    """ Shrink a typed dataset: drop the PII columns, store the remaining text columns that repeat
+    as categoricals and downcast the numbers (COMPACT_DTYPES). Columns that don't fit their
+    compact dtype exactly (missing years, prices with cents) are kept as float32 or as they are.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    df (DataFrame) -- typed dataset, from clean_dataset
+
+    Returns:
+    df (DataFrame) -- compact dataset
+    """
+    df = df.drop(columns=[col for col in PII_COLUMNS if col in df.columns])
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object and values.nunique() <= len(values) // 2:
+            df[col] = values.astype('category')
+        elif col in COMPACT_DTYPES:
+            dtype = np.dtype(COMPACT_DTYPES[col])
+            if dtype.kind == 'i':
+                info = np.iinfo(dtype)
+                exact = values.notna().all() and (values % 1 == 0).all() and values.between(info.min, info.max).all()
+                if not exact:
+                    dtype = np.dtype('float32') if values.dtype.kind == 'f' else values.dtype
+            df[col] = values.astype(dtype)
+    return df
+
+
+def memory_report(before, after):
+    """ Summary of the memory saved by compacting the datasets.
     Arguments:
-    None
+    before (dict) -- dataset name -> bytes in memory as loaded
+    after (dict) -- dataset name -> bytes in memory compacted
+
+    Returns:
+    report (str)
+    """
+    parts = [f"{name} {before[name] / 2**20:.1f} -> {after[name] / 2**20:.1f} MiB" for name in before]
+    saved = sum(before.values()) - sum(after.values())
+    return f"Compact schema saved {saved / 2**20:.1f} MiB ({', '.join(parts)})"
+
+
+def read_manifest():
+    """ Read the cache manifest, if there is one.
+    Returns:
+    manifest (dict) -- cache schema and source file signatures per dataset
+    """
+    try:
+        with open(cache_path() + "/manifest.json") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'schema' : CACHE_SCHEMA, 'sources' : {}}
+
+    if manifest.get('schema') != CACHE_SCHEMA:
+        return {'schema' : CACHE_SCHEMA, 'sources' : {}}
+    return manifest
+
+
+def write_manifest(manifest):
+    """ Atomically write the cache manifest (several workers may start at once).
+    Arguments:
+    manifest (dict) -- cache schema and source file signatures per dataset
+    """
+    tmp = cache_path() + f"/manifest.json.{os.getpid()}"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, cache_path() + "/manifest.json")
+
+
+def write_table(df, file_path):
+    """ Write a dataframe to an uncompressed Arrow file, atomically (several workers may start at once).
+    Arguments:
+    df (DataFrame) -- dataframe to write
+    file_path (str) -- path of the Arrow file
+    """
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    tmp = file_path + f".{os.getpid()}"
+    with pa.OSFile(tmp, 'wb') as f, pa.ipc.new_file(f, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, file_path)
+
+
+def map_table(file_path, drop=()):
+    """ Memory map an Arrow file written by write_table. Numeric, date and categorical columns
+    without missing values point straight into the mapped file (read only), so their pages are
+    only read from disk when they are used; other columns are copied.
+    Arguments:
+    file_path (str) -- path of the Arrow file
+    drop (list) -- columns not to load, they are never read
+
+    Returns:
+    df (DataFrame)
+    """
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map(file_path)).read_all()
+    if len(drop) > 0:
+        table = table.drop([col for col in drop if col in table.column_names])
+    return table.to_pandas(split_blocks=True)
+
+
+def cache_is_fresh(name, manifest):
+    """ Check if the cached copy of a dataset still matches its source csv.
+    The mtime/size check is free; the sha1 is only computed when the mtime changed,
+    so touching a file without editing it does not trigger a rebuild.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    manifest (dict) -- cache manifest, updated in place if only the mtime moved
+
+    Returns:
+    fresh (bool) -- True if the cached file can be used
+    """
+    cached = manifest['sources'].get(name)
+    if (cached is None) or (not os.path.exists(cache_path() + f"/{name}.arrow")):
+        return False
+
+    source = assets_path() + "/" + DATASETS[name]
+    current = file_signature(source, with_hash=False)
+    if (current['mtime'] == cached['mtime']) and (current['size'] == cached['size']):
+        return True
+    if (current['size'] != cached['size']) or ('sha1' not in cached):
+        return False
+
+    current = file_signature(source)
+    if current['sha1'] != cached['sha1']:
+        return False
+    manifest['sources'][name] = current
+    return True
+
+
+def write_cache(name, df, manifest, signature):
+    """ Save a typed dataset to the cache.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    df (DataFrame) -- typed dataset
+    manifest (dict) -- cache manifest, updated in place
+    signature (dict) -- signature of the source csv the dataset was read from
+    """
+    os.makedirs(cache_path(), exist_ok=True)
+    write_table(df, cache_path() + f"/{name}.arrow")
+    manifest['sources'][name] = signature
+
+    # Appended batches are part of the new file now
+    for part in manifest.setdefault('parts', {}).pop(name, []):
+        try:
+            os.remove(cache_path() + "/" + part)
+        except OSError:
+            pass
+
+
+def append_cache(name, batch, manifest, signature):
+    """ Save a typed batch that was appended to a source csv as an extra part of the cached dataset,
+    so the cache stays fresh without rewriting (or re-parsing) the rows already in it.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    batch (DataFrame) -- typed batch
+    manifest (dict) -- cache manifest, updated in place
+    signature (dict) -- signature of the source csv after the batch was appended
+    """
+    parts = manifest.setdefault('parts', {}).setdefault(name, [])
+    part = f"{name}.part{len(parts):05d}.arrow"
+    write_table(batch, cache_path() + "/" + part)
+    parts.append(part)
+    manifest['sources'][name] = signature
+
+
+def read_cache(name, manifest, drop=()):
+    """ Memory map a cached dataset, including any appended parts (which are copied in,
+    until the next full rebuild of the cache).
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    manifest (dict) -- cache manifest
+    drop (list) -- columns not to load
+
+    Returns:
+    df (DataFrame) -- typed dataset
+    """
+    df = map_table(cache_path() + f"/{name}.arrow", drop)
+    parts = manifest.get('parts', {}).get(name, [])
+    if len(parts) > 0:
+        df = pd.concat([df] + [map_table(cache_path() + "/" + part, drop) for part in parts])
+        for col in CATEGORICAL_COLUMNS[name]:
+            df[col] = df[col].astype('category') # Parts have their own categories
+    return df
+
+
+def load_dataset(name, use_cache=True, manifest=None, drop=()):
+    """ Load a single typed dataset, from the cache when it is fresh.
+    Arguments:
+    name (str) -- dataset name, one of DATASETS
+    use_cache (bool) -- read from/write to the cache if possible
+    manifest (dict) -- cache manifest, read from disk if not provided
+    drop (list) -- columns not to load. Only saves work when reading from the cache,
+                   the csv is always parsed in full
+
+    Returns:
+    df (DataFrame) -- typed dataset
+    """
+    use_cache = use_cache and arrow_available()
+    if use_cache:
+        manifest = read_manifest() if manifest is None else manifest
+        if cache_is_fresh(name, manifest):
+            try:
+                return read_cache(name, manifest, drop)
+            except Exception:
+                pass # Unreadable cache, fall through and rebuild it
+
+    source = assets_path() + "/" + DATASETS[name]
+    signature = file_signature(source) if use_cache else None
+    df = clean_dataset(name, pd.read_csv(source, index_col=0))
+
+    if use_cache:
+        try:
+            write_cache(name, df, manifest, signature)
+        except OSError:
+            pass # Read-only deployments just keep using the csv files
+    return df.drop(columns=[col for col in drop if col in df.columns])
+
+
+def load_data(use_cache=True, compact=COMPACT_DATA, report=False):
+    """ Load the data into the code from the cache, or the csv files if the cache
+    is missing or out of date.
+    Arguments:
+    use_cache (bool) -- read from/write to the cache if possible
+    compact (bool) -- shrink the datasets in memory with compact_dataset (the cache keeps every column)
+    report (bool) -- print the memory compacting saved (see memory_report), e.g. from benchmark.py
 
     Returns:
     purchases (DataFrame) -- a dataframe of purchase data
     opportunities (DataFrame) -- a dataframe of opportunity data
     competitors (DataFrame) -- a dataframe of competitor data
+    financials (DataFrame) -- a dataframe of financial data
+    """
+    manifest = read_manifest() if (use_cache and arrow_available()) else None
+    # The compact schema drops the PII columns, so they aren't even loaded
+    drop = PII_COLUMNS if compact else ()
+    data = [load_dataset(name, use_cache, manifest, drop) for name in DATASETS]
+
+    if manifest is not None:
+        try:
+            write_manifest(manifest)
+        except OSError:
+            pass
+
+    if compact:
+        if report:
+            before = {name : df.memory_usage(deep=True).sum() for name, df in zip(DATASETS, data)}
+        data = [compact_dataset(name, df) for name, df in zip(DATASETS, data)]
+        if report:
+            after = {name : df.memory_usage(deep=True).sum() for name, df in zip(DATASETS, data)}
+            print(memory_report(before, after))
+
+    purchases, opportunities, competitors, financials = data
+    return purchases, opportunities, competitors, financials
+
+
+def shared_path():
+    """ Path of the shared (memory mapped) datasets directory.
+    Returns:
+    path (str) -- path to the shared directory
+    """
+    return cache_path() + "/shared"
+
+
+def publish_shared(data, tag):
+    """ Write the datasets as uncompressed Arrow files that workers can memory map, replacing
+    any older published versions. Workers still mapping an older version keep their mapping.
+    Arguments:
+    data (list) -- the four datasets, as returned by load_data
+    tag (str) -- version tag of the datasets, the directory they are published to
+    """
+    tmp = shared_path() + f"/.{tag}.{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for name, df in zip(DATASETS, data):
+        write_table(df, tmp + f"/{name}.arrow")
+
+    try:
+        os.replace(tmp, shared_path() + "/" + tag)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True) # Published by someone else in the meantime
+    for old in os.listdir(shared_path()):
+        if old != tag and not old.startswith('.') and os.path.isdir(shared_path() + "/" + old):
+            shutil.rmtree(shared_path() + "/" + old, ignore_errors=True)
+
+
+def attach_shared(tag):
+    """ Memory map published datasets (see map_table).
+    Arguments:
+    tag (str) -- version tag the datasets were published under
+
+    Returns:
+    data (list) -- the four datasets, as load_data returns them
     """
-    # Import data
-    pth = os.path.dirname(os.getcwd()) # Go up one directory
-    purchases = pd.read_csv(pth+"/assets/purchases.csv", index_col=0)
-    opportunities = pd.read_csv(pth+"/assets/opportunities.csv", index_col=0)
-    competitors = pd.read_csv(pth+"/assets/competitor_data.csv", index_col=0)
-    financials = pd.read_csv(pth+"/assets/financials.csv", index_col=0)
-
-    # Data cleaning
-    purchases['opportunity_created'] = pd.to_datetime(purchases['opportunity_created'])
-    purchases['date_purchased'] = pd.to_datetime(purchases['date_purchased'])
-    purchases['pct_financed'] = np.where(purchases['financed'] == False, 0, purchases['pct_financed']) # Formatting data where Mockaroo would not cooperate
-    purchases['month'] = purchases['date_purchased'].dt.month
-    purchases['year'] = purchases['date_purchased'].dt.year
-
-    opportunities['opportunity_created'] = pd.to_datetime(opportunities['opportunity_created'])
-    opportunities['month'] = opportunities['opportunity_created'].dt.month
-    opportunities['year'] = opportunities['opportunity_created'].dt.year
-    
-    
-    competitors['date_purchased'] = pd.to_datetime(competitors['date_purchased'])
-    competitors['month'] = competitors['date_purchased'].dt.month
+    return [map_table(shared_path() + f"/{tag}/{name}.arrow") for name in DATASETS]
 
+
+def load_shared(compact=COMPACT_DATA):
+    """ load_data, but sharing one copy of the datasets between processes. The first process
+    to ask for the current data version loads and publishes it (the others wait on a lock),
+    then every process memory maps the published files.
+    Falls back to load_data if pyarrow isn't installed or the cache directory isn't writable.
+    Arguments:
+    compact (bool) -- publish the datasets with the compact schema (see compact_dataset)
+
+    Returns:
+    purchases, opportunities, competitors, financials (DataFrame) -- as load_data returns them
+    """
+    if not arrow_available():
+        return load_data(compact=compact)
+
+    tag = f"{data_version()}-{CACHE_SCHEMA}" + ("-compact" if compact else "")
+    try:
+        if not os.path.isdir(shared_path() + "/" + tag):
+            os.makedirs(shared_path(), exist_ok=True)
+            with open(shared_path() + "/.publish.lock", 'w') as lock:
+                try:
+                    import fcntl
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                except ImportError:
+                    pass # No file locks (Windows), at worst each worker publishes the same files
+                if not os.path.isdir(shared_path() + "/" + tag):
+                    publish_shared(load_data(compact=compact), tag)
+        purchases, opportunities, competitors, financials = attach_shared(tag)
+    except OSError:
+        return load_data(compact=compact)
     return purchases, opportunities, competitors, financials
 
+
+# Dataset name -> (make column, model column) used by the dropdown filters
+FILTER_COLUMNS = {'purchases' : ('car_make', 'car_model'),
+                  'opportunities' : ('car_make_interest', 'car_model_interest'),
+                  'competitors' : ('car_make', 'car_model'),
+                  'monthly_cube' : ('car_make', 'car_model')}
+
+# Dimensions and measures of the monthly cube
+CUBE_DIMENSIONS = ['year', 'month', 'car_make', 'car_model', 'car_tier']
+CUBE_MEASURES = ['purchase_count', 'revenue', 'sales_cycle_days', 'sales_cycle_count', 'opportunity_count']
+
+
+def build_monthly_cube(purchases, opportunities):
+    """ Pre-aggregate purchases and opportunities by month, make, model and tier, so the time
+    series charts only have to sum up a few rows per month instead of grouping the raw data.
+    Opportunities have no tier, so their rows have an empty car_tier.
+    Arguments:
+    purchases (DataFrame) -- purchase data from load_data (or None to leave them out)
+    opportunities (DataFrame) -- opportunity data from load_data (or None to leave them out)
+
+    Returns:
+    monthly cube (DataFrame) -- one row per (year, month, make, model, tier) with the CUBE_MEASURES:
+                                purchase count, revenue (purchase_price sum), sales cycle days sum (and the
+                                number of purchases it covers) and opportunity count
+    """
+    # Group on plain objects, pandas drops missing makes/models from categorical groupbys even with dropna=False
+    cubes = []
+    if purchases is not None:
+        p = purchases[['date_purchased', 'purchase_price', 'sales_cycle_days']].copy()
+        p[CUBE_DIMENSIONS] = purchases[CUBE_DIMENSIONS].astype(object)
+        cubes.append(p.groupby(CUBE_DIMENSIONS, dropna=False).agg(purchase_count=('date_purchased', 'count'),
+                                                                  revenue=('purchase_price', 'sum'),
+                                                                  sales_cycle_days=('sales_cycle_days', 'sum'),
+                                                                  sales_cycle_count=('sales_cycle_days', 'count')).reset_index())
+
+    if opportunities is not None:
+        o = opportunities[['year', 'month', 'car_make_interest', 'car_model_interest', 'opportunity_created']].astype(
+                {'car_make_interest' : object, 'car_model_interest' : object})
+        o = o.rename(columns={'car_make_interest' : 'car_make', 'car_model_interest' : 'car_model'})
+        o['car_tier'] = None
+        cubes.append(o.groupby(CUBE_DIMENSIONS, dropna=False).agg(opportunity_count=('opportunity_created', 'count')).reset_index())
+
+    cube = pd.concat(cubes, ignore_index=True).reindex(columns=CUBE_DIMENSIONS + CUBE_MEASURES)
+    cube[CUBE_MEASURES] = cube[CUBE_MEASURES].fillna(0).astype(np.int64)
+    for col in ['car_make', 'car_model', 'car_tier']:
+        cube[col] = cube[col].astype('category')
+    return cube
+
+
+def merge_cubes(cube, other):
+    """ Add the measures of two monthly cubes together, e.g. to fold a new batch into the cube.
+    Arguments:
+    cube (DataFrame) -- monthly cube from build_monthly_cube
+    other (DataFrame) -- monthly cube from build_monthly_cube
+
+    Returns:
+    monthly cube (DataFrame) -- combined cube
+    """
+    merged = pd.concat([cube, other], ignore_index=True)
+    merged[CUBE_DIMENSIONS] = merged[CUBE_DIMENSIONS].astype(object)
+    merged = merged.groupby(CUBE_DIMENSIONS, dropna=False)[CUBE_MEASURES].sum().reset_index()
+    for col in ['car_make', 'car_model', 'car_tier']:
+        merged[col] = merged[col].astype('category')
+    return merged
+
+
+def load_monthly_cube(purchases, opportunities, version, use_cache=True):
+    """ Load the monthly cube from the cache if it was built for this version of the data,
+    otherwise build it (and cache it).
+    Arguments:
+    purchases (DataFrame) -- purchase data from load_data
+    opportunities (DataFrame) -- opportunity data from load_data
+    version (str) -- version of the loaded data (data_version)
+    use_cache (bool) -- read from/write to the cache if possible
+
+    Returns:
+    monthly cube (DataFrame) -- see build_monthly_cube
+    """
+    use_cache = use_cache and arrow_available()
+    if use_cache:
+        manifest = read_manifest()
+        if manifest.get('monthly_cube') == version:
+            try:
+                return pd.read_parquet(cache_path() + "/monthly_cube.parquet")
+            except Exception:
+                pass
+
+    cube = build_monthly_cube(purchases, opportunities)
+    if use_cache:
+        try:
+            write_cube_cache(cube, version)
+        except OSError:
+            pass
+    return cube
+
+
+def write_cube_cache(cube, version):
+    """ Save the monthly cube to the parquet cache.
+    Arguments:
+    cube (DataFrame) -- monthly cube
+    version (str) -- version of the data the cube was built from (data_version)
+    """
+    os.makedirs(cache_path(), exist_ok=True)
+    tmp = cache_path() + f"/monthly_cube.parquet.{os.getpid()}"
+    cube.to_parquet(tmp)
+    os.replace(tmp, cache_path() + "/monthly_cube.parquet")
+    manifest = read_manifest()
+    manifest['monthly_cube'] = version
+    write_manifest(manifest)
+
+
+def build_filter_index(purchases, opportunities, competitors, monthly_cube=None):
+    """ Build a lookup of row positions for every make and make/model combination, so that
+    filtering on the dropdowns is a take of the matching rows rather than a scan of the whole frame.
+    Arguments:
+    purchases (DataFrame) -- purchase data from load_data
+    opportunities (DataFrame) -- opportunity data from load_data
+    competitors (DataFrame) -- competitor data from load_data
+    monthly_cube (DataFrame) -- monthly cube from build_monthly_cube, indexed too if given
+
+    Returns:
+    filter index (dict) -- per dataset, {'make' : {make : positions}, 'make_model' : {(make, model) : positions}}
+    """
+    datasets = {'purchases' : purchases, 'opportunities' : opportunities, 'competitors' : competitors}
+    if monthly_cube is not None:
+        datasets['monthly_cube'] = monthly_cube
+
+    index = {}
+    for name, df in datasets.items():
+        make_col, model_col = FILTER_COLUMNS[name]
+        index[name] = {'make' : df.groupby(make_col, observed=True, sort=False).indices,
+                       'make_model' : df.groupby([make_col, model_col], observed=True, sort=False).indices}
+    return index
+
+
+def filter_rows(df, index, make_value=None, model_value=None):
+    """ Filter a dataset on the make/model dropdowns using its filter index.
+    If no make is selected the full dataset is returned as is (not copied).
+    Arguments:
+    df (DataFrame) -- dataset the index was built from
+    index (dict) -- the dataset's entry from build_filter_index
+    make_value (str) -- make dropdown value
+    model_value (str) -- model dropdown value
+
+    Returns:
+    data (DataFrame) -- matching rows, in their original order
+    """
+    if make_value is None:
+        return df
+    if model_value is None:
+        positions = index['make'].get(make_value)
+    else:
+        positions = index['make_model'].get((make_value, model_value))
+
+    if positions is None:
+        return df.iloc[:0]
+    return df.take(positions)
+
+
+def filter_positions(index, makes):
+    """ Row positions of every row whose make is in a set of makes.
+    Arguments:
+    index (dict) -- the dataset's entry from build_filter_index
+    makes (iterable) -- makes to keep
+
+    Returns:
+    positions (ndarray) -- sorted row positions
+    """
+    positions = [index['make'][make] for make in makes if make in index['make']]
+    if len(positions) == 0:
+        return np.array([], dtype=np.intp)
+    return np.sort(np.concatenate(positions))
+
+
+def filter_makes(df, index, makes):
+    """ Rows of a dataset whose make is in a set of makes. If that is every row,
+    the full dataset is returned as is (not copied).
+    Arguments:
+    df (DataFrame) -- dataset the index was built from
+    index (dict) -- the dataset's entry from build_filter_index
+    makes (iterable) -- makes to keep
+
+    Returns:
+    data (DataFrame) -- matching rows, in their original order
+    """
+    makes = set(makes)
+    if makes.issuperset(index['make']) and sum(len(p) for p in index['make'].values()) == len(df):
+        return df
+    return df.take(filter_positions(index, makes))
+
+
+def models_for_make(index, make_value=None):
+    """ Sorted model names available for a make (or for every make).
+    Arguments:
+    index (dict) -- the dataset's entry from build_filter_index
+    make_value (str) -- make dropdown value
+
+    Returns:
+    models (list) -- sorted model names
+    """
+    return sorted({model for (make, model) in index['make_model'] if (make_value is None) or (make == make_value)})
+
+
+class LRUCache:
+    """ Small thread-safe least-recently-used cache shared by the app's result caches.
+    Arguments:
+    maxsize (int) -- number of entries kept before the least recently used is evicted
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()